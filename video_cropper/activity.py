@@ -0,0 +1,112 @@
+import bisect
+import logging
+import os
+from typing import Union, Callable
+
+import cv2
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def activity_cache_filename(videofile: Union[str, os.PathLike]) -> str:
+    return str(videofile).rstrip('/\\') + '.activity.npz'
+
+
+def compute_activity(reader, width: int = 64, cancel: Callable[[], bool] = None,
+                     callback: Callable[[int, np.ndarray], None] = None,
+                     callback_every: int = 256) -> Union[np.ndarray, None]:
+    """Computes a cheap per-frame activity signal: mean absolute difference between consecutive frames, after
+    downsampling them to a width-pixel-wide grayscale thumbnail.
+
+    Streams over the reader once, holding only two thumbnails in memory.
+
+    Args:
+        reader: a vidio-style reader, positioned at frame 0
+        width: width of the thumbnails the difference is computed on
+        cancel: called every frame. If it returns True, stops and returns None
+        callback: called as callback(start, values) every callback_every frames with the newly computed values, so
+            that a display can be updated while the computation runs
+    Returns:
+        float32 array with one value per frame. The first frame has activity 0
+    """
+    activity = np.zeros(len(reader), dtype=np.float32)
+    previous, current, diff = None, None, None
+    last_reported = 0
+    n = 0
+    for i, frame in enumerate(reader):
+        if cancel is not None and cancel():
+            return None
+        if i >= len(activity):
+            # OpenCV's frame count is only an estimate
+            activity = np.concatenate((activity, np.zeros(len(activity) // 2 + 1, dtype=np.float32)))
+        if frame.ndim == 3 and frame.shape[2] > 1:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2GRAY if frame.shape[2] == 4 else cv2.COLOR_RGB2GRAY)
+        if current is None:
+            H, W = frame.shape[:2]
+            size = (min(width, W), max(int(round(H * min(width, W) / W)), 1))
+            current = np.empty((size[1], size[0]), dtype=frame.dtype)
+            previous = np.empty_like(current)
+            diff = np.empty_like(current)
+        cv2.resize(frame, current.shape[::-1], dst=current, interpolation=cv2.INTER_AREA)
+        if i > 0:
+            activity[i] = cv2.absdiff(current, previous, dst=diff).mean()
+        previous, current = current, previous
+        n = i + 1
+        if callback is not None and n - last_reported >= callback_every:
+            callback(last_reported, activity[last_reported:n].copy())
+            last_reported = n
+    activity = activity[:n]
+    if callback is not None and n > last_reported:
+        callback(last_reported, activity[last_reported:n].copy())
+    return activity
+
+
+def save_activity(videofile: Union[str, os.PathLike], activity: np.ndarray):
+    """Caches an activity signal next to the video, along with the video's size and mtime to detect changes"""
+    stat = os.stat(videofile)
+    np.savez(activity_cache_filename(videofile), activity=activity, size=stat.st_size, mtime=stat.st_mtime)
+
+
+def load_activity(videofile: Union[str, os.PathLike]) -> Union[np.ndarray, None]:
+    """Loads a cached activity signal, or returns None if there is none or the video has changed since"""
+    cachefile = activity_cache_filename(videofile)
+    if not os.path.isfile(cachefile):
+        return None
+    try:
+        stat = os.stat(videofile)
+        with np.load(cachefile) as f:
+            if int(f['size']) != stat.st_size or float(f['mtime']) != stat.st_mtime:
+                return None
+            return f['activity']
+    except Exception as e:
+        log.warning('Could not load activity cache {}: {}'.format(cachefile, e))
+        return None
+
+
+def find_events(activity: np.ndarray, threshold: float = None) -> np.ndarray:
+    """Returns the frames where activity rises above threshold.
+
+    By default the threshold is the median plus 5 median absolute deviations, ignoring frames that haven't been
+    computed yet (NaN).
+    """
+    valid = activity[np.isfinite(activity)]
+    if len(valid) == 0:
+        return np.zeros(0, dtype=int)
+    if threshold is None:
+        median = np.median(valid)
+        mad = np.median(np.abs(valid - median))
+        threshold = median + 5 * max(mad, 1e-3)
+    above = np.nan_to_num(activity, nan=0.0) > threshold
+    onsets = np.flatnonzero(above & ~np.concatenate(([False], above[:-1])))
+    return onsets
+
+
+def next_event(events: np.ndarray, current: int) -> Union[int, None]:
+    index = bisect.bisect_right(events, current)
+    return int(events[index]) if index < len(events) else None
+
+
+def previous_event(events: np.ndarray, current: int) -> Union[int, None]:
+    index = bisect.bisect_left(events, current) - 1
+    return int(events[index]) if index >= 0 else None
@@ -0,0 +1,70 @@
+from functools import lru_cache
+from typing import Union
+
+import numpy as np
+
+
+def dtype_range(image: np.ndarray) -> tuple:
+    """Guesses the range of values a camera actually uses, e.g. 12-bit data stored as uint16 -> (0, 4095)"""
+    if image.dtype == np.uint8:
+        return 0, 255
+    if image.dtype.kind != 'u':
+        raise ValueError('No default range for dtype {}'.format(image.dtype))
+    bits = max(int(np.ceil(np.log2(int(image.max()) + 1))), 8)
+    return 0, 2 ** bits - 1
+
+
+def make_lut(low: int, high: int, in_dtype: Union[str, np.dtype] = np.uint16,
+             out_dtype: Union[str, np.dtype] = np.uint8) -> np.ndarray:
+    """Lookup table mapping every value of in_dtype linearly from [low, high] onto the full range of out_dtype.
+
+    Values outside [low, high] saturate. Apply it with apply_lut.
+    """
+    in_max, out_max = np.iinfo(in_dtype).max, np.iinfo(out_dtype).max
+    high = max(high, low + 1)
+    lut = np.arange(in_max + 1, dtype=np.float64)
+    lut = np.clip((lut - low) * (out_max / (high - low)), 0, out_max)
+    return np.round(lut).astype(out_dtype)
+
+
+def apply_lut(image: np.ndarray, lut: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """Maps every pixel through lut in one pass, writing into out if given. No float temporaries"""
+    if out is None:
+        out = np.empty(image.shape, dtype=lut.dtype)
+    return np.take(lut, image, out=out)
+
+
+@lru_cache(maxsize=16)
+def bit_depth_lut(bit_depth: int) -> np.ndarray:
+    """make_lut for bit_depth-bit data stored as uint16, built once per bit_depth and shared, so it's read-only"""
+    lut = make_lut(0, 2 ** bit_depth - 1)
+    lut.flags.writeable = False
+    return lut
+
+
+def convert_dtype(image: np.ndarray, dtype: Union[str, np.dtype], out: np.ndarray = None,
+                  bit_depth: int = None) -> np.ndarray:
+    """Reduces bit depth of an image without float temporaries where possible.
+
+    uint16 -> uint8 keeps the 8 most significant bits, or, with bit_depth (e.g. 12 for 12-bit data in a uint16), the
+    8 most significant of those. Floats are assumed to be in [0, 1], and are the only case that needs a temporary.
+    """
+    dtype = np.dtype(dtype)
+    if image.dtype == dtype:
+        return image
+    if out is None:
+        out = np.empty(image.shape, dtype=dtype)
+    if image.dtype == np.uint16 and dtype == np.uint8:
+        if bit_depth is None or bit_depth >= 16:
+            np.right_shift(image, 8, out=out, casting='unsafe')
+        else:
+            apply_lut(image, bit_depth_lut(bit_depth), out=out)
+    elif image.dtype == np.uint8 and dtype == np.uint16:
+        out[...] = image
+        np.left_shift(out, 8, out=out)
+    elif image.dtype.kind == 'f' and dtype.kind == 'u':
+        maxval = np.iinfo(dtype).max
+        np.copyto(out, np.clip(image * maxval, 0, maxval), casting='unsafe')
+    else:
+        raise ValueError('Unsupported dtype conversion: {} -> {}'.format(image.dtype, dtype))
+    return out
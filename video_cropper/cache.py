@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Union, Sequence
+
+from .crop import crop_video
+from .writers import disk_usage, encoder_settings, output_filename, shard_filename, shard_index_filename
+
+# Linux ioctl to make a copy-on-write clone of a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def fingerprint(path: Union[str, os.PathLike], n_blocks: int = 16, block_size: int = 65536) -> str:
+    """Fast fingerprint of a video: its size, mtime, and a hash of n_blocks blocks spread evenly through the file.
+
+    Image folders hash every file's name, size and mtime; shard indices also fingerprint their shards.
+    """
+    path = str(path)
+    h = hashlib.blake2b(digest_size=16)
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            stat = os.stat(os.path.join(path, name))
+            h.update('{}:{}:{}\n'.format(name, stat.st_size, stat.st_mtime_ns).encode())
+        return h.hexdigest()
+    stat = os.stat(path)
+    h.update('{}:{}\n'.format(stat.st_size, stat.st_mtime_ns).encode())
+    with open(path, 'rb') as f:
+        step = max((stat.st_size - block_size) // max(n_blocks - 1, 1), 1)
+        for offset in sorted(set(min(i * step, max(stat.st_size - block_size, 0)) for i in range(n_blocks))):
+            f.seek(offset)
+            h.update(f.read(block_size))
+    if path.endswith('.shards.json'):
+        directory = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r') as f:
+            for shard in json.load(f)['shards']:
+                h.update(fingerprint(os.path.join(directory, shard['filename'])).encode())
+    return h.hexdigest()
+
+
+def clone_file(src: str, dst: str):
+    """Reflink if the filesystem supports it, otherwise hard link, otherwise copy. Replaces dst if it exists.
+
+    A hard link shares its data with src, so src is made read-only first: anything that later opens the link for
+    writing fails instead of silently changing src.
+    """
+    tmp = '{}.tmp-{}'.format(dst, uuid.uuid4().hex[:8])
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (ImportError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            os.chmod(src, 0o444)
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def clone(src: str, dst: str):
+    if os.path.isdir(src):
+        if os.path.exists(dst):
+            raise ValueError('Directory already exists: {}'.format(dst))
+        os.makedirs(dst)
+        for name in os.listdir(src):
+            clone(os.path.join(src, name), os.path.join(dst, name))
+    else:
+        clone_file(src, dst)
+
+
+class ResultCache:
+    """Content-addressed cache of crop_video outputs, so identical crops are never computed twice.
+
+    The key covers a fingerprint of the source, the crop rectangle, every option that changes the output, and the
+    encoder settings of each format. Outputs are stored under directory/objects/KEY, and handed out as reflinks or hard
+    links (copies if neither works), so a hit costs no decoding or encoding. Hard links share data with the cache, so
+    hard-linked entries are made read-only, and crop_video replaces existing outputs rather than truncating them. Least
+    recently used entries are evicted once the cache is larger than max_bytes. Hits, misses and bytes saved are
+    accumulated in directory/stats.json.
+
+    Example:
+        cache = ResultCache('/data/crop_cache', max_bytes=500e9)
+        result = cache.crop_video('movie.mp4', 'movie_cropped.mp4', 10, 10, 200, 200)
+        print(result['cache'], cache.stats())
+    """
+    # options to crop_video that don't change its output
+    ignored = ['buffer_size', 'cancel', 'verify']
+
+    def __init__(self, directory: Union[str, os.PathLike], max_bytes: float = None):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(self.directory, 'objects'), exist_ok=True)
+
+    def entry(self, key: str) -> str:
+        return os.path.join(self.directory, 'objects', key)
+
+    def key(self, infile: Union[str, os.PathLike], movie_formats: Sequence[str], **kwargs) -> str:
+        spec = {k: v for k, v in kwargs.items() if k not in self.ignored}
+        spec['source'] = fingerprint(infile)
+        spec['movie_formats'] = list(movie_formats)
+        spec['encoders'] = [encoder_settings.get(i) for i in movie_formats]
+        return hashlib.blake2b(json.dumps(spec, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def read_meta(self, key: str) -> Union[dict, None]:
+        try:
+            with open(os.path.join(self.entry(key), 'meta.json'), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_json(self, filename: str, data: dict):
+        tmp = '{}.tmp-{}'.format(filename, uuid.uuid4().hex[:8])
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, filename)
+
+    def crop_video(self, infile: Union[str, os.PathLike], outfile: Union[str, os.PathLike], x: int, y: int, w: int,
+                   h: int, movie_format: Union[str, Sequence[str]] = 'ffmpeg', **kwargs) -> dict:
+        """Same as crop.crop_video, but returns cached outputs when possible.
+
+        The returned dict also has 'cache' ('hit' or 'miss') and 'bytes_saved'.
+        """
+        movie_formats = [movie_format] if isinstance(movie_format, str) else list(movie_format)
+        key = self.key(infile, movie_formats, x=x, y=y, w=w, h=h, **kwargs)
+        meta = self.read_meta(key)
+        hit = meta is not None
+        if not hit:
+            meta = self.compute(key, infile, x, y, w, h, movie_formats, **kwargs)
+        outputs = self.materialize(key, meta, outfile, movie_formats)
+        meta['last_used'] = time.time()
+        self.write_json(os.path.join(self.entry(key), 'meta.json'), meta)
+        self.update_stats(hit, meta['bytes'] if hit else 0)
+        if not hit:
+            self.evict()
+        result = dict(meta['result'])
+        if 'verification' in result:
+            # verification records name outputs relative to the entry, like meta['outputs']
+            targets = dict(zip(meta['outputs'], outputs))
+            result['verification'] = [dict(i, output=targets.get(i['output'], i['output']))
+                                      for i in result['verification']]
+        result.update({'outputs': outputs, 'cache': 'hit' if hit else 'miss',
+                       'bytes_saved': meta['bytes'] if hit else 0})
+        return result
+
+    def compute(self, key: str, infile, x, y, w, h, movie_formats, **kwargs) -> dict:
+        # crop into a temporary entry, then rename it into place, so concurrent identical crops don't collide
+        tmp = os.path.join(self.directory, 'objects', '.tmp-{}-{}'.format(key, uuid.uuid4().hex[:8]))
+        os.makedirs(tmp)
+        try:
+            result = crop_video(infile, os.path.join(tmp, 'out'), x, y, w, h, movie_format=movie_formats, **kwargs)
+            if 'verification' in result:
+                for verification in result['verification']:
+                    verification['output'] = os.path.basename(verification['output'])
+            meta = {'key': key, 'infile': os.path.abspath(str(infile)), 'movie_formats': movie_formats,
+                    'outputs': [os.path.basename(i) for i in result['outputs']],
+                    'result': {k: v for k, v in result.items() if k != 'outputs'},
+                    'bytes': sum(disk_usage(i) for i in result['outputs']),
+                    'created': time.time(), 'last_used': time.time()}
+            self.write_json(os.path.join(tmp, 'meta.json'), meta)
+            try:
+                os.rename(tmp, self.entry(key))
+            except OSError:
+                # someone else finished the same crop first. use theirs
+                shutil.rmtree(tmp, ignore_errors=True)
+                meta = self.read_meta(key)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return meta
+
+    def materialize(self, key: str, meta: dict, outfile, movie_formats: Sequence[str]) -> list:
+        """Clones an entry's outputs to where crop_video would have written them for outfile"""
+        entry = self.entry(key)
+        outputs = []
+        for movie_format, cached in zip(movie_formats, meta['outputs']):
+            target = output_filename(outfile, movie_format, strip_suffix=len(movie_formats) > 1)
+            if cached.endswith('.shards.json'):
+                with open(os.path.join(entry, cached), 'r') as f:
+                    index = json.load(f)
+                for i, shard in enumerate(index['shards']):
+                    name = shard_filename(target, i)
+                    clone(os.path.join(entry, shard['filename']), name)
+                    shard['filename'] = os.path.basename(name)
+                target = shard_index_filename(target)
+                self.write_json(target, index)
+            else:
+                clone(os.path.join(entry, cached), target)
+            outputs.append(target)
+        return outputs
+
+    def evict(self):
+        """Removes least recently used entries until the cache is under max_bytes"""
+        if self.max_bytes is None:
+            return
+        metas = [self.read_meta(key) for key in os.listdir(os.path.join(self.directory, 'objects'))
+                 if not key.startswith('.tmp-')]
+        metas = sorted([i for i in metas if i is not None], key=lambda meta: meta['last_used'])
+        total = sum(meta['bytes'] for meta in metas)
+        while total > self.max_bytes and len(metas) > 0:
+            meta = metas.pop(0)
+            shutil.rmtree(self.entry(meta['key']), ignore_errors=True)
+            total -= meta['bytes']
+
+    def stats(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, 'stats.json'), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+
+    def update_stats(self, hit: bool, bytes_saved: int):
+        # not locked: concurrent updates can lose a count, which is fine for statistics
+        stats = self.stats()
+        stats['hits' if hit else 'misses'] += 1
+        stats['bytes_saved'] += bytes_saved
+        self.write_json(os.path.join(self.directory, 'stats.json'), stats)
@@ -1,11 +1,17 @@
 import argparse
 import os
 import pathlib
-from typing import Union
+import time
+import warnings
+from typing import Callable, Union, Sequence
 
+import cv2
 import numpy as np
 from tqdm import tqdm
-from vidio import VideoReader, VideoWriter
+
+from .bitdepth import convert_dtype
+from .readers import open_video
+from .writers import TeeWriter, even_formats, output_filename
 
 
 def crop(image: np.ndarray, x: int, y: int, w: int, h: int) -> np.ndarray:
@@ -13,25 +19,158 @@ def crop(image: np.ndarray, x: int, y: int, w: int, h: int) -> np.ndarray:
     return image[y:y + h, x:x + w, ...]
 
 
+class CropTransform:
+    """Crops, then optionally converts to grayscale, downsamples, and reduces bit depth in one pass.
+
+    Everything after the crop only touches the cropped region, and intermediate results are written into buffers
+    that are allocated on the first frame and reused afterwards. Frames returned by __call__ are therefore only valid
+    until the next call; copy them if they need to outlive that.
+
+    Args:
+        x, y, w, h: cropping rectangle in the input frame
+        scale: integer downsampling factor. 2 means half width and half height. Uses area (box) averaging
+        grayscale: if True, convert RGB input to a single channel
+        dtype: output data type, e.g. 'uint8'. None keeps the input dtype
+        bit_depth: number of bits actually used by uint16 input, e.g. 12. Used when reducing to uint8
+    """
+
+    def __init__(self, x: int, y: int, w: int, h: int, scale: int = 1, grayscale: bool = False,
+                 dtype: Union[str, np.dtype] = None, bit_depth: int = None):
+        if scale < 1 or int(scale) != scale:
+            raise ValueError('scale must be a positive integer, not {}'.format(scale))
+        self.scale = int(scale)
+        self.x, self.y = x, y
+        # only crop whole blocks so that area downsampling is exact
+        self.w, self.h = w - w % self.scale, h - h % self.scale
+        self.grayscale = grayscale
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.bit_depth = bit_depth
+
+        self._gray = None
+        self._small = None
+        self._out = None
+
+    @property
+    def output_size(self):
+        """(width, height) of frames produced by this transform"""
+        return self.w // self.scale, self.h // self.scale
+
+    def __call__(self, image: np.ndarray) -> np.ndarray:
+        image = crop(image, self.x, self.y, self.w, self.h)
+
+        if self.grayscale and image.ndim == 3 and image.shape[2] > 1:
+            if self._gray is None:
+                self._gray = np.empty(image.shape[:2], dtype=image.dtype)
+            code = cv2.COLOR_RGBA2GRAY if image.shape[2] == 4 else cv2.COLOR_RGB2GRAY
+            image = cv2.cvtColor(image, code, dst=self._gray)
+
+        if self.scale > 1:
+            out_w, out_h = self.output_size
+            if self._small is None:
+                self._small = np.empty((out_h, out_w) + image.shape[2:], dtype=image.dtype)
+            # with an integer factor, INTER_AREA is an exact box average over scale x scale blocks
+            image = cv2.resize(image, (out_w, out_h), dst=self._small, interpolation=cv2.INTER_AREA)
+
+        if self.dtype is not None and image.dtype != self.dtype:
+            if self._out is None:
+                self._out = np.empty(image.shape, dtype=self.dtype)
+            image = convert_dtype(image, self.dtype, out=self._out, bit_depth=self.bit_depth)
+        return image
+
+
+def make_even(w: int, h: int, scale: int = 1):
+    """libx264 and MJPG need even output dimensions. drops whole blocks from the bottom / right if not"""
+    out_w, out_h = w // scale, h // scale
+    if out_w % 2 or out_h % 2:
+        warnings.warn('with ffmpeg or opencv, output width and height must be even. adjusting...')
+        w, h = (out_w - out_w % 2) * scale, (out_h - out_h % 2) * scale
+    return w, h
+
+
 def crop_video(infile: Union[str, os.PathLike, pathlib.Path],
                outfile: Union[str, os.PathLike, pathlib.Path],
                x: int,
                y: int,
                w: int,
                h: int,
-               movie_format: str = 'ffmpeg'):
-    with VideoReader(infile) as reader:
-        with VideoWriter(outfile, movie_format=movie_format, asynchronous=False, fps=reader.fps) as writer:
-            # import pdb; pdb.set_trace()
-            for frame in tqdm(reader):
-                writer.write(crop(frame, x, y, w, h))
+               movie_format: Union[str, Sequence[str]] = 'ffmpeg',
+               scale: int = 1,
+               grayscale: bool = False,
+               dtype: str = None,
+               buffer_size: int = 64,
+               shard_frames: int = None,
+               shard_seconds: float = None,
+               bit_depth: int = None,
+               cancel: Callable[[], bool] = None,
+               verify: bool = True) -> dict:
+    """Crops a video, writing one output per movie format from a single decode + crop pass.
+
+    With several movie formats, any video extension on outfile is replaced by each format's default extension, e.g.
+    movie_format=['ffmpeg', 'hdf5'] writes outfile.mp4 and outfile.h5. Each output is encoded on its own thread, with at
+    most buffer_size frames queued per output.
+
+    With shard_frames or shard_seconds, each output is split into fixed-length shards with a JSON index instead; see
+    writers.ShardedWriter. infile can itself be a shard index.
+
+    Frames are written at their native bit depth and number of channels (e.g. 1-channel uint16) to the formats that
+    support it (hdf5, directory). Formats that only support 8 bits get a uint8 copy, using bit_depth if given.
+
+    If cancel is given, it is called every frame, and a RuntimeError is raised as soon as it returns True.
+
+    With verify, a sample of output frames is compared with the source afterwards (see verify.verify_crop), and a
+    RuntimeError is raised if any output doesn't match.
+
+    Returns:
+        dict with the number of frames written, wall time in seconds, throughput in frames per second, the output
+        files (shard indices for sharded outputs), and the verification results if verify
+    """
+    movie_formats = [movie_format] if isinstance(movie_format, str) else list(movie_format)
+    filenames = [output_filename(outfile, fmt, strip_suffix=len(movie_formats) > 1) for fmt in movie_formats]
+    if any(i in even_formats for i in movie_formats):
+        w, h = make_even(w, h, scale)
+    transform = CropTransform(x, y, w, h, scale=scale, grayscale=grayscale, dtype=dtype, bit_depth=bit_depth)
+
+    start_time = time.perf_counter()
+    nframes = 0
+    with open_video(infile) as reader:
+        if shard_seconds is not None:
+            shard_frames = max(int(round(shard_seconds * reader.fps)), 1)
+        # the first frame tells us whether the source is mono
+        first = transform(next(reader))
+        in_colorspace = 'GRAY' if first.ndim == 2 or first.shape[2] == 1 else 'RGB'
+        with TeeWriter(filenames, movie_formats, buffer_size=buffer_size, shard_frames=shard_frames,
+                       bit_depth=bit_depth, fps=reader.fps, in_colorspace=in_colorspace) as writer:
+            writer.write(first)
+            nframes += 1
+            for frame in tqdm(reader, total=len(reader), initial=1):
+                if cancel is not None and cancel():
+                    raise RuntimeError('Cropping {} was cancelled'.format(infile))
+                writer.write(transform(frame))
+                nframes += 1
+        outputs = writer.output_files
+    seconds = time.perf_counter() - start_time
+    result = {'nframes': nframes,
+              'seconds': seconds,
+              'fps': nframes / seconds if seconds > 0 else 0.0,
+              'outputs': outputs}
+    if verify:
+        # imported here because verify uses CropTransform
+        from .verify import verify_crop
+        result['verification'] = verify_crop(infile, outputs, x, y, w, h, scale=scale, grayscale=grayscale,
+                                             dtype=dtype, bit_depth=bit_depth, nframes=nframes)
+        failed = [i for i in result['verification'] if not i['ok']]
+        if len(failed) > 0:
+            raise RuntimeError('Verification failed: {}'.format(
+                '; '.join('{}: {}'.format(i['output'], ', '.join(i['errors'])) for i in failed)))
+    return result
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Crop video')
     parser.add_argument('-i', '--infile', required=True, type=str,
                         help='file to read')
-    parser.add_argument('-o', '--outfile', required=True, type=str,
-                        help='filename of video to write')
+    parser.add_argument('-o', '--outfile', required=False, type=str,
+                        help='filename of video to write. required unless --estimate')
     parser.add_argument('-x', required=True, type=int,
                         help='x coordinate of top-left corner')
     parser.add_argument('-y', required=True, type=int,
@@ -40,8 +179,51 @@ if __name__ == '__main__':
                         help='width')
     parser.add_argument('--height', required=True, type=int,
                         help='height')
-    parser.add_argument('--movie_format', default='ffmpeg', type=str,
-                        help='format of output movie. see vidio on github')
+    parser.add_argument('--movie_format', default=['ffmpeg'], type=str, nargs='+',
+                        help='format(s) of output movie. see vidio on github. with several formats, all are written '
+                             'from the same pass')
+    parser.add_argument('--scale', default=1, type=int,
+                        help='integer downsampling factor applied after cropping. 2 = half resolution')
+    parser.add_argument('--grayscale', default=False, action='store_true',
+                        help='convert cropped frames to a single grayscale channel')
+    parser.add_argument('--dtype', default=None, type=str, choices=['uint8', 'uint16'],
+                        help='output data type. default: same as input')
+    parser.add_argument('--shard_frames', default=None, type=int,
+                        help='split output into files of this many frames, plus a .shards.json index')
+    parser.add_argument('--shard_seconds', default=None, type=float,
+                        help='split output into files of this many seconds, plus a .shards.json index')
+    parser.add_argument('--bit_depth', default=None, type=int,
+                        help='bits actually used by 16-bit input, e.g. 12. used when converting to 8 bits')
+    parser.add_argument('--estimate', default=False, action='store_true',
+                        help='instead of cropping, predict runtime and output size for each --movie_format from a '
+                             'sample of frames')
+    parser.add_argument('--no_verify', default=False, action='store_true',
+                        help="don't compare a sample of output frames with the source after cropping")
+    parser.add_argument('--cache_dir', default=None, type=str,
+                        help='reuse outputs of identical earlier crops stored here, and store this one')
+    parser.add_argument('--cache_max_gb', default=None, type=float,
+                        help='evict least recently used cache entries beyond this size')
     args = parser.parse_args()
+    if args.estimate:
+        from .estimate import estimate_crop, format_estimate
+        results = estimate_crop(args.infile, args.x, args.y, args.w, args.height, movie_formats=args.movie_format,
+                                scale=args.scale, grayscale=args.grayscale, dtype=args.dtype, bit_depth=args.bit_depth)
+        print(format_estimate(results))
+        raise SystemExit
+    if args.outfile is None:
+        parser.error('-o/--outfile is required')
+    kwargs = dict(scale=args.scale, grayscale=args.grayscale, dtype=args.dtype, shard_frames=args.shard_frames,
+                  shard_seconds=args.shard_seconds, bit_depth=args.bit_depth, verify=not args.no_verify)
     # have to use --height instead of -h because -h means help
-    crop_video(args.infile, args.outfile, args.x, args.y, args.w, args.height, args.movie_format)
\ No newline at end of file
+    if args.cache_dir is None:
+        crop_video(args.infile, args.outfile, args.x, args.y, args.w, args.height, args.movie_format, **kwargs)
+    else:
+        from .cache import ResultCache
+        max_bytes = None if args.cache_max_gb is None else args.cache_max_gb * 1e9
+        cache = ResultCache(args.cache_dir, max_bytes=max_bytes)
+        result = cache.crop_video(args.infile, args.outfile, args.x, args.y, args.w, args.height, args.movie_format,
+                                  **kwargs)
+        stats = cache.stats()
+        print('cache {}: {} frames, {:.1f} MB saved. cache totals: {} hits, {} misses, {:.1f} MB saved'.format(
+            result['cache'], result['nframes'], result['bytes_saved'] / 1e6, stats['hits'], stats['misses'],
+            stats['bytes_saved'] / 1e6))
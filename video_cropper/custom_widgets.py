@@ -2,18 +2,31 @@ from PySide2 import QtCore, QtGui, QtWidgets
 from PySide2.QtWidgets import (QGroupBox, QFormLayout, QLabel, QLineEdit, QVBoxLayout, QWidget, QMainWindow)
 from PySide2.QtCore import Qt, Signal, Slot, QPoint
 from PySide2.QtGui import QPainter, QBrush, QPen, QPixmap
-from typing import Union, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Union, Tuple, Sequence
 import os
 
-from vidio import VideoReader
+import cv2
 import numpy as np
 
+from .bitdepth import apply_lut, dtype_range, make_lut
+from .activity import compute_activity, load_activity, save_activity, find_events, next_event, previous_event
+from .readers import open_video
+from .session import load_thumbnail
+
 
 def numpy_to_qpixmap(image: np.ndarray) -> QtGui.QPixmap:
-    if image.dtype == np.float:
+    if image.dtype.kind == 'f':
         image = float_to_uint8(image)
-    H, W, C = int(image.shape[0]), int(image.shape[1]), int(image.shape[2])
-    if C == 4:
+    if image.ndim == 3 and image.shape[2] == 1:
+        image = image[..., 0]
+    H, W = int(image.shape[0]), int(image.shape[1])
+    C = 1 if image.ndim == 2 else int(image.shape[2])
+    if image.dtype != np.uint8:
+        raise ValueError('Aberrant dtype for a {}-channel image: {}'.format(C, image.dtype))
+    elif C == 1:
+        format = QtGui.QImage.Format_Grayscale8
+    elif C == 4:
         format = QtGui.QImage.Format_RGBA8888
     elif C == 3:
         format = QtGui.QImage.Format_RGB888
@@ -27,8 +40,11 @@ def numpy_to_qpixmap(image: np.ndarray) -> QtGui.QPixmap:
 
 
 def float_to_uint8(image: np.ndarray) -> np.ndarray:
-    if image.dtype == np.float:
-        image = (image * 255).clip(min=0, max=255).astype(np.uint8)
+    if image.dtype.kind == 'f':
+        # one temporary, then in place
+        image = np.multiply(image, 255)
+        np.clip(image, 0, 255, out=image)
+        image = image.astype(np.uint8)
     # print(image)
     return (image)
 
@@ -40,6 +56,8 @@ def initializer(nframes: int):
 class VideoFrame(QtWidgets.QGraphicsView):
     frameNum = Signal(int)
     initialized = Signal(int)
+    # window / level used to display frames, as (low, high). emitted with a default when a video is opened
+    displayRange = Signal(int, int)
 
     def __init__(self, videoFile: Union[str, os.PathLike] = None, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -61,6 +79,11 @@ class VideoFrame(QtWidgets.QGraphicsView):
         self.setMinimumSize(QtCore.QSize(640, 480))
         # self.setObjectName("videoView")
 
+        self.display_range = None
+        self._lut = None
+        self._display_buffer = None
+        self.owns_reader = True
+
         if videoFile is not None:
             self.initialize_video(videoFile)
             self.update()
@@ -68,13 +91,18 @@ class VideoFrame(QtWidgets.QGraphicsView):
 
         # print(self.palette())
 
-    def initialize_video(self, videofile: Union[str, os.PathLike]):
-        if hasattr(self, 'vid'):
+    def initialize_video(self, videofile: Union[str, os.PathLike], reader=None):
+        """Shows a video. If reader is given, it's used instead of opening the video, and whoever opened it closes it"""
+        if hasattr(self, 'vid') and self.owns_reader:
             self.vid.close()
             # if hasattr(self.vid, 'cap'):
             #     self.vid.cap.release()
         self.videofile = videofile
-        self.vid = VideoReader(videofile)
+        self.owns_reader = reader is None
+        self.vid = open_video(videofile) if reader is None else reader
+        self.display_range = None
+        self._lut = None
+        self._display_buffer = None
         # self.frame = next(self.vid)
         self.initialized.emit(len(self.vid))
         # there was a bug where sometimes subsequent videos with the same frame would not update the image
@@ -138,7 +166,34 @@ class VideoFrame(QtWidgets.QGraphicsView):
         if new_height < H:
             self.setFixedHeight(new_height)
 
+    @Slot(int, int)
+    def set_display_range(self, low: int, high: int):
+        if self.display_range == (low, high):
+            return
+        self.display_range = (low, high)
+        self._lut = None
+        if hasattr(self, 'frame'):
+            self.show_image(self.frame)
+
+    def normalize_for_display(self, array: np.ndarray) -> np.ndarray:
+        """Applies the window / level to integer frames through a lookup table, into a reused buffer"""
+        if array.dtype.kind != 'u':
+            return array
+        if self.display_range is None:
+            self.display_range = dtype_range(array)
+            self.displayRange.emit(*self.display_range)
+        full_range = (0, np.iinfo(array.dtype).max)
+        if self.display_range == full_range and array.dtype == np.uint8:
+            return array
+        # QImage.Format_Grayscale16 needs Qt 5.13, so everything else goes through the lookup table to 8 bits
+        if self._lut is None or self._lut.shape[0] != full_range[1] + 1:
+            self._lut = make_lut(*self.display_range, in_dtype=array.dtype)
+        if self._display_buffer is None or self._display_buffer.shape != array.shape:
+            self._display_buffer = np.empty(array.shape, dtype=np.uint8)
+        return apply_lut(array, self._lut, out=self._display_buffer)
+
     def show_image(self, array):
+        array = self.normalize_for_display(array)
         qpixmap = numpy_to_qpixmap(array)
         # THIS LINE CHANGES THE SCENE WIDTH AND HEIGHT
         self._photo.setPixmap(qpixmap)
@@ -152,6 +207,116 @@ class VideoFrame(QtWidgets.QGraphicsView):
             self.fitInView()
 
 
+class ActivityWorker(QtCore.QThread):
+    """Computes the activity signal of a video in the background, then caches it next to the video"""
+    progress = Signal(int, object)
+    computed = Signal(object)
+
+    def __init__(self, videofile: Union[str, os.PathLike], parent=None):
+        super().__init__(parent)
+        self.videofile = videofile
+
+    def run(self):
+        # separate reader, so we never share one with the GUI thread
+        reader = open_video(self.videofile)
+        try:
+            activity = compute_activity(reader, cancel=self.isInterruptionRequested, callback=self.progress.emit)
+        finally:
+            reader.close()
+        if activity is None:
+            return
+        try:
+            save_activity(self.videofile, activity)
+        except OSError as e:
+            print('Could not cache activity for {}: {}'.format(self.videofile, e))
+        self.computed.emit(activity)
+
+
+class ActivityStrip(QtWidgets.QWidget):
+    """Heat strip of per-frame activity. Frames not computed yet are drawn gray. Click to jump to a frame.
+
+    While the activity is being computed, each chunk only updates its own part of the strip. Events and the color
+    scale over the whole video are computed once, by set_activity, when it's done.
+    """
+    position = Signal(int)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.activity = np.zeros(0, dtype=np.float32)
+        self.events = np.zeros(0, dtype=int)
+        self.scale = 1.0
+        self._image = None
+        self.setMinimumHeight(8)
+        self.setMaximumHeight(8)
+        self.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Fixed)
+
+    def initialize(self, nframes: int):
+        self.activity = np.full(nframes, np.nan, dtype=np.float32)
+        self.events = np.zeros(0, dtype=int)
+        self.scale = 1.0
+        self._image = None
+        self.update()
+
+    @Slot(int, object)
+    def set_values(self, start: int, values: np.ndarray):
+        end = min(start + len(values), len(self.activity))
+        values = values[:end - start]
+        self.activity[start:end] = values
+        # provisional scale from the chunks seen so far. only looks at the new chunk, so it stays cheap on long videos
+        finite = values[np.isfinite(values)]
+        if len(finite) > 0:
+            self.scale = max(self.scale if start > 0 else 0, float(np.percentile(finite, 99)))
+        self._image = None
+        self.update()
+
+    @Slot(object)
+    def set_activity(self, activity: np.ndarray):
+        """The whole activity signal: computes events and the color scale once"""
+        self.set_values(0, activity)
+        valid = self.activity[np.isfinite(self.activity)]
+        self.scale = float(np.percentile(valid, 99)) if len(valid) > 0 else 1.0
+        self.events = find_events(self.activity)
+        self._image = None
+        self.update()
+
+    def render_image(self, width: int) -> QtGui.QImage:
+        # one column per pixel, showing the maximum activity of the frames in it
+        n = len(self.activity)
+        edges = np.linspace(0, n, width + 1).astype(int)
+        edges = np.minimum(edges, n - 1)
+        binned = np.fmax.reduceat(self.activity, edges[:-1])
+        valid = np.isfinite(binned)
+        scale = self.scale if self.scale > 0 else 1
+        levels = (np.clip(np.nan_to_num(binned, nan=0.0) / scale, 0, 1) * 255).astype(np.uint8)
+        colors = cv2.applyColorMap(levels[np.newaxis, :], cv2.COLORMAP_INFERNO)[..., ::-1]
+        colors[0, ~valid] = 64
+        colors = np.ascontiguousarray(colors)
+        image = QtGui.QImage(colors, width, 1, colors.strides[0], QtGui.QImage.Format_RGB888)
+        # QImage doesn't own the numpy buffer
+        return image.copy()
+
+    def paintEvent(self, event):
+        if len(self.activity) == 0 or self.width() < 1:
+            return
+        if self._image is None or self._image.width() != self.width():
+            self._image = self.render_image(self.width())
+        painter = QPainter(self)
+        painter.drawImage(self.rect(), self._image)
+        painter.end()
+
+    def mousePressEvent(self, event):
+        if len(self.activity) == 0:
+            return
+        fraction = min(max(event.pos().x() / max(self.width(), 1), 0), 1)
+        self.position.emit(int(fraction * (len(self.activity) - 1)))
+
+    def next_event(self, current: int):
+        return next_event(self.events, current)
+
+    def previous_event(self, current: int):
+        return previous_event(self.events, current)
+
+
 class ScrollbarWithText(QtWidgets.QWidget):
     position = Signal(int)
 
@@ -181,7 +346,22 @@ class ScrollbarWithText(QtWidgets.QWidget):
         self.horizontalScrollBar.setMaximumSize(QtCore.QSize(16777215, 25))
         self.horizontalScrollBar.setOrientation(QtCore.Qt.Horizontal)
         self.horizontalScrollBar.setObjectName("horizontalScrollBar")
-        self.horizontalLayout.addWidget(self.horizontalScrollBar)
+        # activity heat strip directly under the scrollbar, so that they line up
+        self.activityStrip = ActivityStrip()
+        scrollbarLayout = QtWidgets.QVBoxLayout()
+        scrollbarLayout.setContentsMargins(0, 0, 0, 0)
+        scrollbarLayout.setSpacing(1)
+        scrollbarLayout.addWidget(self.horizontalScrollBar)
+        scrollbarLayout.addWidget(self.activityStrip)
+        self.horizontalLayout.addLayout(scrollbarLayout)
+        self.previousEvent = QtWidgets.QToolButton()
+        self.previousEvent.setArrowType(QtCore.Qt.LeftArrow)
+        self.previousEvent.setToolTip('Previous event')
+        self.horizontalLayout.addWidget(self.previousEvent)
+        self.nextEvent = QtWidgets.QToolButton()
+        self.nextEvent.setArrowType(QtCore.Qt.RightArrow)
+        self.nextEvent.setToolTip('Next event')
+        self.horizontalLayout.addWidget(self.nextEvent)
         self.plainTextEdit = QtWidgets.QPlainTextEdit(self.horizontalWidget)
         self.plainTextEdit.setEnabled(True)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Maximum)
@@ -202,12 +382,25 @@ class ScrollbarWithText(QtWidgets.QWidget):
         self.plainTextEdit.textChanged.connect(self.text_change)
         self.horizontalScrollBar.sliderMoved.connect(self.scrollbar_change)
         self.horizontalScrollBar.valueChanged.connect(self.scrollbar_change)
+        self.activityStrip.position.connect(self.position.emit)
+        self.previousEvent.clicked.connect(self.jump_to_previous_event)
+        self.nextEvent.clicked.connect(self.jump_to_next_event)
 
         self.update()
         # self.show()
 
     def sizeHint(self):
-        return QtCore.QSize(480, 25)
+        return QtCore.QSize(480, 35)
+
+    def jump_to_next_event(self):
+        value = self.activityStrip.next_event(self.horizontalScrollBar.value())
+        if value is not None:
+            self.position.emit(value)
+
+    def jump_to_previous_event(self):
+        value = self.activityStrip.previous_event(self.horizontalScrollBar.value())
+        if value is not None:
+            self.position.emit(value)
 
     def text_change(self):
         value = self.plainTextEdit.document().toPlainText()
@@ -235,6 +428,7 @@ class ScrollbarWithText(QtWidgets.QWidget):
         # self.horizontalScrollBar.valueChanged.connect(self.scrollbar_change)
         self.horizontalScrollBar.setValue(0)
         self.plainTextEdit.setPlainText('{}'.format(0))
+        self.activityStrip.initialize(value)
         # self.plainTextEdit.textChanged.connect(self.text_change)
         # self.update()
 
@@ -273,14 +467,107 @@ class VideoPlayer(QtWidgets.QWidget):
         if hasattr(self.videoView, 'vid'):
             self.videoView.initialized.emit(len(self.videoView.vid))
 
+        self.activityWorker = None
         self.update()
 
+    def start_activity(self, videofile: Union[str, os.PathLike]):
+        """Shows the cached activity of a video in the scrollbar, or starts computing it in the background"""
+        self.stop_activity()
+        activity = load_activity(videofile)
+        if activity is not None:
+            self.scrollbartext.activityStrip.set_activity(activity)
+            return
+        self.activityWorker = ActivityWorker(videofile, parent=self)
+        self.activityWorker.progress.connect(self.scrollbartext.activityStrip.set_values)
+        self.activityWorker.computed.connect(self.scrollbartext.activityStrip.set_activity)
+        self.activityWorker.start(QtCore.QThread.LowPriority)
+
+    def stop_activity(self):
+        if self.activityWorker is None:
+            return
+        self.activityWorker.requestInterruption()
+        self.activityWorker.wait()
+        self.activityWorker = None
+
+
+class ThumbnailWorker(QtCore.QThread):
+    """Decodes one thumbnail per video on a pool of threads, emitting each as soon as it's ready"""
+    loaded = Signal(str, object)
+    failed = Signal(str, str)
+
+    def __init__(self, videofiles: Sequence[str], num_workers: int = None, parent=None):
+        super().__init__(parent)
+        self.videofiles = list(videofiles)
+        self.num_workers = num_workers if num_workers is not None else min(os.cpu_count() or 1, 8)
+
+    def run(self):
+        # each thumbnail opens its own reader, so none are shared with the GUI thread
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            futures = {pool.submit(load_thumbnail, videofile): videofile for videofile in self.videofiles}
+            for future in as_completed(futures):
+                if self.isInterruptionRequested():
+                    for i in futures:
+                        i.cancel()
+                    return
+                try:
+                    self.loaded.emit(futures[future], future.result())
+                except Exception as e:
+                    self.failed.emit(futures[future], repr(e))
+
+
+class ThumbnailGrid(QtWidgets.QListWidget):
+    """Grid of video thumbnails. Videos with an ROI are marked. Click one to open it"""
+    videoSelected = Signal(str)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.setViewMode(QtWidgets.QListView.IconMode)
+        self.setIconSize(QtCore.QSize(160, 120))
+        self.setResizeMode(QtWidgets.QListView.Adjust)
+        self.setMovement(QtWidgets.QListView.Static)
+        self.setWordWrap(True)
+        self.setMinimumWidth(200)
+        self.setMaximumWidth(360)
+        self.items = {}
+        self.currentItemChanged.connect(self.item_changed)
+
+    def set_videos(self, videofiles: Sequence[str]):
+        self.clear()
+        self.items = {}
+        for videofile in videofiles:
+            item = QtWidgets.QListWidgetItem(os.path.basename(videofile), self)
+            item.setData(Qt.UserRole, videofile)
+            self.items[videofile] = item
+
+    @Slot(str, object)
+    def set_thumbnail(self, videofile: str, info: dict):
+        if videofile in self.items:
+            self.items[videofile].setIcon(QtGui.QIcon(numpy_to_qpixmap(info['thumbnail'])))
+            H, W = info['shape']
+            self.items[videofile].setToolTip('{}\n{} x {}, {} frames'.format(videofile, W, H, info['nframes']))
+
+    @Slot(str, str)
+    def set_failed(self, videofile: str, error: str):
+        if videofile in self.items:
+            self.items[videofile].setToolTip('{}\ncould not read: {}'.format(videofile, error))
+            self.items[videofile].setForeground(QBrush(Qt.red))
+
+    def set_has_roi(self, videofile: str, has_roi: bool):
+        if videofile in self.items:
+            name = os.path.basename(videofile)
+            self.items[videofile].setText(name + ' [ROI]' if has_roi else name)
+
+    def item_changed(self, current, previous):
+        if current is not None:
+            self.videoSelected.emit(current.data(Qt.UserRole))
+
 
 class Toolbar(QtWidgets.QWidget):
     Width = Signal(float)
     Height = Signal(float)
     X = Signal(float)
     Y = Signal(float)
+    DisplayRange = Signal(int, int)
 
     def __init__(self, parent=None, *args, **kwargs):
         # https://pythonspot.com/pyqt5-form-layout/
@@ -298,6 +585,9 @@ class Toolbar(QtWidgets.QWidget):
         self.openVideo.setMaximumSize(QtCore.QSize(200, 16777215))
         self.openVideo.setObjectName("openVideo")
         self.openVideo.setText('Open Video')
+        self.openFolder = QtWidgets.QPushButton(self.verticalWidget)
+        self.openFolder.setMaximumSize(QtCore.QSize(200, 16777215))
+        self.openFolder.setText('Open Folder')
 
         # self.formGroupBox = QGroupBox('Form Layout')
         self.widget = QtWidgets.QWidget(self.verticalWidget)
@@ -318,25 +608,63 @@ class Toolbar(QtWidgets.QWidget):
 
         exportWidget = QWidget(self.verticalWidget)
         exportLayout = QFormLayout()
-        self.exportFormat = QtWidgets.QComboBox()
+        # checkable list so that several formats can be written from one crop
+        self.exportFormat = QtWidgets.QListWidget()
         self.formats = {'libx264': 'ffmpeg',
                         'MJPG': 'opencv',
                         'HDF5': 'hdf5',
                         'image folder': 'directory'}
-        for fmt in list(self.formats.keys()):
-            self.exportFormat.addItem(fmt)
+        for i, fmt in enumerate(list(self.formats.keys())):
+            item = QtWidgets.QListWidgetItem(fmt, self.exportFormat)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if i == 0 else Qt.Unchecked)
+        self.exportFormat.setMaximumHeight(80)
         exportLayout.addRow(QLabel('Format: '), self.exportFormat)
+        self.scaleSpinBox = QtWidgets.QSpinBox()
+        self.scaleSpinBox.setMinimum(1)
+        self.scaleSpinBox.setMaximum(16)
+        self.scaleSpinBox.setValue(1)
+        exportLayout.addRow(QLabel('Downsample: '), self.scaleSpinBox)
+        self.grayscaleCheckBox = QtWidgets.QCheckBox()
+        exportLayout.addRow(QLabel('Grayscale: '), self.grayscaleCheckBox)
         # self.exportName = QLineEdit()
         # exportLayout.addRow(QLabel('Name: '), self.exportName)
         exportWidget.setSizePolicy(sizePolicy)
         exportWidget.setLayout(exportLayout)
 
+        displayWidget = QWidget(self.verticalWidget)
+        displayLayout = QFormLayout()
+        self.displayLow = QtWidgets.QSpinBox()
+        self.displayHigh = QtWidgets.QSpinBox()
+        for spinbox in [self.displayLow, self.displayHigh]:
+            spinbox.setRange(0, 65535)
+            spinbox.setKeyboardTracking(False)
+        self.displayHigh.setValue(255)
+        displayLayout.addRow(QLabel('Display min: '), self.displayLow)
+        displayLayout.addRow(QLabel('Display max: '), self.displayHigh)
+        displayWidget.setSizePolicy(sizePolicy)
+        displayWidget.setLayout(displayLayout)
+
         mainLayout = QVBoxLayout()
         mainLayout.addWidget(self.openVideo)
+        mainLayout.addWidget(self.openFolder)
         mainLayout.addWidget(self.widget)
+        mainLayout.addWidget(displayWidget)
         mainLayout.addWidget(exportWidget)
+        self.estimateButton = QtWidgets.QPushButton(text='Estimate')
+        self.estimateButton.setToolTip('Predict time and disk space for each format from a sample of frames')
+        mainLayout.addWidget(self.estimateButton)
         self.cropButton = QtWidgets.QPushButton(text='Crop')
         mainLayout.addWidget(self.cropButton)
+        # only useful with a folder open
+        self.copyRoiButton = QtWidgets.QPushButton(text='Copy ROI to same size')
+        self.copyRoiButton.setToolTip('Give this ROI to every video in the folder with the same resolution')
+        mainLayout.addWidget(self.copyRoiButton)
+        self.cropAllButton = QtWidgets.QPushButton(text='Crop all')
+        self.cropAllButton.setToolTip('Queue every video in the folder that has an ROI for cropping')
+        mainLayout.addWidget(self.cropAllButton)
+        for button in [self.copyRoiButton, self.cropAllButton]:
+            button.setEnabled(False)
         mainLayout.setAlignment(QtCore.Qt.AlignTop | QtCore.Qt.AlignLeft)
 
         self.setLayout(mainLayout)
@@ -344,6 +672,8 @@ class Toolbar(QtWidgets.QWidget):
         self.width_edit.returnPressed.connect(self.text_changed)
         self.x_edit.returnPressed.connect(self.text_changed)
         self.y_edit.returnPressed.connect(self.text_changed)
+        self.displayLow.valueChanged.connect(self.display_range_changed)
+        self.displayHigh.valueChanged.connect(self.display_range_changed)
 
         self.update()
 
@@ -375,6 +705,18 @@ class Toolbar(QtWidgets.QWidget):
         if current_y != '{}'.format(value):
             self.y_edit.setText(str(int(value)))
 
+    @Slot(int, int)
+    def update_display_range(self, low: int, high: int):
+        for spinbox, value in [(self.displayLow, low), (self.displayHigh, high)]:
+            spinbox.blockSignals(True)
+            spinbox.setValue(value)
+            spinbox.blockSignals(False)
+
+    def display_range_changed(self):
+        low, high = self.displayLow.value(), self.displayHigh.value()
+        if high > low:
+            self.DisplayRange.emit(low, high)
+
     def text_changed(self):
         x, y, w, h = self.x_edit.text(), self.y_edit.text(), self.width_edit.text(), self.height_edit.text()
         if x != '':
@@ -391,6 +733,14 @@ class Toolbar(QtWidgets.QWidget):
             self.Height.emit(h)
         # print(x, y, w, h)
 
+    def selected_formats(self) -> list:
+        formats = []
+        for i in range(self.exportFormat.count()):
+            item = self.exportFormat.item(i)
+            if item.checkState() == Qt.Checked:
+                formats.append(self.formats[item.text()])
+        return formats
+
     def clear_text(self):
         self.x_edit.setText('')
         self.y_edit.setText('')
@@ -438,6 +788,19 @@ class CroppingOverlay(QtWidgets.QGraphicsScene):
         self.has_rect = True
 
 
+    def show_rect(self, x, y, w, h):
+        """Draws a rectangle without the mouse, e.g. one saved for this video"""
+        if self._rect is None:
+            self._rect = QtWidgets.QGraphicsRectItem()
+            pen = QPen(Qt.black, 2, Qt.SolidLine, Qt.FlatCap, Qt.MiterJoin)
+            self._rect.setPen(pen)
+            self._rect.setFlag(QtWidgets.QGraphicsItem.ItemIsMovable, False)
+            self.addItem(self._rect)
+            self.has_rect = True
+        self.first = False
+        self._rect.setRect(x, y, w, h)
+        self.emit_rect()
+
     def clear_rect(self):
         if self._rect is None:
             return
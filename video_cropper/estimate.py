@@ -0,0 +1,151 @@
+import os
+import tempfile
+import time
+from typing import Callable, Union, Sequence
+
+import numpy as np
+
+from .bitdepth import convert_dtype
+from .crop import CropTransform
+from .readers import open_video
+from .writers import disk_usage, even_formats, make_writer, native_formats, output_filename
+
+
+def interval(values: Sequence[float], scale: float = 1.0) -> tuple:
+    """(low, estimate, high): the mean of values times scale, with a 95% confidence interval on the mean"""
+    values = np.asarray(values, dtype=np.float64)
+    mean = values.mean()
+    sem = values.std(ddof=1) / np.sqrt(len(values)) if len(values) > 1 else 0.0
+    return max(mean - 1.96 * sem, 0) * scale, mean * scale, (mean + 1.96 * sem) * scale
+
+
+def estimate_crop(infile: Union[str, os.PathLike], x: int, y: int, w: int, h: int,
+                  movie_formats: Sequence[str] = ('ffmpeg', 'opencv', 'hdf5', 'directory'),
+                  n_runs: int = 24, run_length: int = 8, scale: int = 1, grayscale: bool = False,
+                  dtype: str = None, bit_depth: int = None, cancel: Callable[[], bool] = None) -> dict:
+    """Predicts crop_video's runtime and output size from a sample of the source, without cropping all of it.
+
+    Reads n_runs short runs of run_length consecutive frames, spread evenly across the source, and times decoding them
+    (excluding the seek to the start of each run), cropping them, and encoding them with each format into a temporary
+    directory. Per-frame costs are averaged over runs and extrapolated to the whole video. Each output is encoded on
+    its own thread in crop_video, so a format's wall time is the slower of reading + cropping and encoding. The
+    verification pass crop_video runs afterwards by default is not included.
+
+    If cancel is given, it is called before each run and each format, and a RuntimeError is raised as soon as it
+    returns True.
+
+    Returns:
+        dict with nframes, and for each movie format a dict with seconds, fps and bytes as (low, estimate, high)
+        95% confidence intervals, or an error message if the format could not be encoded
+    """
+    reader = open_video(infile)
+    try:
+        nframes = len(reader)
+        if nframes == 0:
+            raise ValueError('Cannot estimate a crop of {}: it has no frames'.format(infile))
+        run_length = max(min(run_length, nframes), 1)
+        n_runs = max(min(n_runs, nframes // run_length), 1)
+        starts = np.linspace(0, nframes - run_length, n_runs).astype(int)
+
+        read_times, crop_times, runs = [], [], []
+        for start in starts:
+            if cancel is not None and cancel():
+                raise RuntimeError('Estimating {} was cancelled'.format(infile))
+            start, stop = int(start), int(start) + run_length
+            if run_length > 1:
+                # the first frame includes seeking, which a sequential crop doesn't do
+                reader[start]
+                start += 1
+            frames = []
+            read_time, crop_time = 0.0, 0.0
+            for i in range(start, stop):
+                t0 = time.perf_counter()
+                frame = reader[i]
+                t1 = time.perf_counter()
+                frames.append(frame)
+                read_time += t1 - t0
+            cropped = []
+            transform = CropTransform(x, y, w, h, scale=scale, grayscale=grayscale, dtype=dtype, bit_depth=bit_depth)
+            for frame in frames:
+                t0 = time.perf_counter()
+                cropped.append(transform(frame).copy())
+                crop_time += time.perf_counter() - t0
+            read_times.append(read_time / len(frames))
+            crop_times.append(crop_time / len(frames))
+            runs.append(cropped)
+    finally:
+        reader.close()
+
+    results = {'nframes': nframes, 'read': interval(read_times, nframes), 'crop': interval(crop_times, nframes)}
+    source_times = np.array(read_times) + np.array(crop_times)
+    for movie_format in movie_formats:
+        if cancel is not None and cancel():
+            raise RuntimeError('Estimating {} was cancelled'.format(infile))
+        try:
+            encode_times, sizes, overhead = estimate_encoding(runs, movie_format, bit_depth=bit_depth)
+        except Exception as e:
+            results[movie_format] = {'error': repr(e)}
+            continue
+        seconds = interval(np.maximum(source_times, encode_times), nframes)
+        fps = tuple(nframes / i if i > 0 else float('inf') for i in seconds[::-1])
+        size = tuple(overhead + i for i in interval(sizes, nframes))
+        results[movie_format] = {'seconds': seconds, 'fps': fps, 'bytes': size}
+    return results
+
+
+def encode_run(run: list, filename: str, movie_format: str, bit_depth: int = None) -> tuple:
+    """Encodes a list of frames as one file. Returns seconds taken and bytes written"""
+    in_colorspace = 'GRAY' if run[0].ndim == 2 else 'RGB'
+    t0 = time.perf_counter()
+    writer = make_writer(filename, movie_format, asynchronous=False, in_colorspace=in_colorspace)
+    for frame in run:
+        if movie_format not in native_formats and frame.dtype != np.uint8:
+            frame = convert_dtype(frame, np.uint8, bit_depth=bit_depth)
+        writer.write(frame)
+    writer.close()
+    return time.perf_counter() - t0, disk_usage(getattr(writer, 'filename', filename))
+
+
+def estimate_encoding(runs: list, movie_format: str, bit_depth: int = None) -> tuple:
+    """Encodes each run of cropped frames as its own file.
+
+    Returns:
+        per-frame seconds and bytes for each run, and the fixed size of a file (headers, preallocated chunks...), which
+        is subtracted from each run so that it's only counted once. The fixed size comes from comparing the first run
+        with a file of just its first frame
+    """
+    if movie_format in even_formats:
+        # like crop_video, libx264 and MJPG get even dimensions
+        H, W = runs[0][0].shape[:2]
+        runs = [[frame[:H - H % 2, :W - W % 2] for frame in run] for run in runs]
+    encode_times, run_sizes = [], []
+    with tempfile.TemporaryDirectory() as directory:
+        for i, run in enumerate(runs):
+            filename = output_filename(os.path.join(directory, 'run{:03d}'.format(i)), movie_format)
+            seconds, size = encode_run(run, filename, movie_format, bit_depth)
+            encode_times.append(seconds / len(run))
+            run_sizes.append(size)
+        filename = output_filename(os.path.join(directory, 'single'), movie_format)
+        _, single_size = encode_run(runs[0][:1], filename, movie_format, bit_depth)
+    run_length = len(runs[0])
+    overhead = single_size - (run_sizes[0] - single_size) / (run_length - 1) if run_length > 1 else 0
+    overhead = min(max(overhead, 0), min(run_sizes))
+    sizes = [(size - overhead) / len(run) for size, run in zip(run_sizes, runs)]
+    return np.array(encode_times), np.array(sizes), overhead
+
+
+def format_estimate(results: dict) -> str:
+    lines = ['{} frames. reading: {:.0f} s, cropping: {:.0f} s'.format(results['nframes'], results['read'][1],
+                                                                      results['crop'][1])]
+    for movie_format, result in results.items():
+        if not isinstance(result, dict):
+            continue
+        if 'error' in result:
+            lines.append('{:>10}: could not encode: {}'.format(movie_format, result['error']))
+            continue
+        seconds, fps, size = result['seconds'], result['fps'], result['bytes']
+        lines.append('{:>10}: {:.0f} s ({:.0f}-{:.0f}), {:.0f} fps ({:.0f}-{:.0f}), {:.1f} MB ({:.1f}-{:.1f})'.format(
+            movie_format, seconds[1], seconds[0], seconds[2], fps[1], fps[0], fps[2],
+            size[1] / 1e6, size[0] / 1e6, size[2] / 1e6))
+    lines.append('(times exclude verification, which reads a sample of frames of each output after cropping)')
+    return '\n'.join(lines)
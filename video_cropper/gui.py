@@ -9,8 +9,11 @@ from PySide2.QtCore import Signal, Slot
 import os
 from typing import Union
 import traceback
-from .custom_widgets import Toolbar, VideoPlayer
+from .custom_widgets import Toolbar, VideoPlayer, ThumbnailGrid, ThumbnailWorker
 from .crop import crop_video
+from .estimate import estimate_crop, format_estimate
+from .session import Session
+from .writers import even_formats
 import warnings
 # import pathlib
 import logging
@@ -24,6 +27,25 @@ log.addHandler(console)
 
 suffixes = ['.h5', '.mp4', '.avi']
 
+class EstimateWorker(QtCore.QThread):
+    estimated = Signal(str)
+
+    def __init__(self, videofile, x, y, w, h, movie_formats, scale, grayscale, parent=None):
+        super().__init__(parent)
+        self.args = (videofile, x, y, w, h)
+        self.kwargs = dict(movie_formats=movie_formats, scale=scale, grayscale=grayscale)
+
+    def run(self):
+        try:
+            text = format_estimate(estimate_crop(*self.args, cancel=self.isInterruptionRequested, **self.kwargs))
+        except BaseException as e:
+            if self.isInterruptionRequested():
+                return
+            text = 'Error estimating: {}'.format(e)
+            print(traceback.format_exc())
+        self.estimated.emit(text)
+
+
 class MainWindow(QMainWindow):
     def __init__(self, debug: bool = False):
         super().__init__()
@@ -36,6 +58,11 @@ class MainWindow(QMainWindow):
         self.videoPlayer = VideoPlayer(parent=self)
         mainLayout.addWidget(self.videoPlayer)
 
+        # shown when a folder is opened
+        self.thumbnailGrid = ThumbnailGrid()
+        self.thumbnailGrid.hide()
+        mainLayout.addWidget(self.thumbnailGrid)
+
         # self.setLayout(mainLayout)
         self.setWindowTitle("Video_cropper")
 
@@ -45,6 +72,9 @@ class MainWindow(QMainWindow):
 
         # define variables needed in functions
         self.videofile = None
+        self.session = None
+        self.thumbnailWorker = None
+        self.estimateWorker = None
 
         # hook up all our signals and slots
 
@@ -61,6 +91,13 @@ class MainWindow(QMainWindow):
         self.toolbar.X.connect(self.overlay.change_x)
         self.toolbar.Y.connect(self.overlay.change_y)
         self.toolbar.cropButton.clicked.connect(self.crop_video)
+        self.toolbar.estimateButton.clicked.connect(self.estimate)
+        self.toolbar.openFolder.clicked.connect(self.open_folder_browser)
+        self.toolbar.copyRoiButton.clicked.connect(self.copy_roi)
+        self.toolbar.cropAllButton.clicked.connect(self.crop_all)
+        self.thumbnailGrid.videoSelected.connect(self.select_video)
+        self.videoPlayer.videoView.displayRange.connect(self.toolbar.update_display_range)
+        self.toolbar.DisplayRange.connect(self.videoPlayer.videoView.set_display_range)
 
         self.update()
         # self.ui = Ui_MainWindow()
@@ -69,7 +106,7 @@ class MainWindow(QMainWindow):
 
     def open_avi_browser(self):
         options = QFileDialog.Options()
-        filestring = 'VideoReader files (*.h5 *.avi *.mp4 *.mov)'
+        filestring = 'VideoReader files (*.h5 *.avi *.mp4 *.mov *.shards.json)'
         filename, _ = QFileDialog.getOpenFileName(self, "Click on video to open", None,
                                                   filestring, options=options)
         if len(filename) == 0 or not os.path.isfile(filename):
@@ -77,15 +114,112 @@ class MainWindow(QMainWindow):
 
         self.initialize_video(filename)
 
-    def initialize_video(self, videofile: Union[str, os.PathLike]):
-        if hasattr(self, 'vid'):
+    def open_folder_browser(self):
+        directory = QFileDialog.getExistingDirectory(self, 'Click on folder of videos to open')
+        if len(directory) == 0 or not os.path.isdir(directory):
+            return
+        self.open_folder(directory)
+
+    def open_folder(self, directory: Union[str, os.PathLike]):
+        """Shows every video in a folder as a thumbnail, and opens the first"""
+        self.stop_thumbnails()
+        session = Session(directory)
+        if len(session.videos) == 0:
+            QMessageBox.warning(self, 'No videos', 'No videos found in {}'.format(directory))
+            return
+        if self.session is not None:
+            self.save_roi()
+            # the view may be showing one of the old session's readers. it's replaced below
+            self.session.close()
+        self.session = session
+        self.thumbnailGrid.set_videos(session.videos)
+        self.thumbnailGrid.show()
+        for button in [self.toolbar.copyRoiButton, self.toolbar.cropAllButton]:
+            button.setEnabled(True)
+        self.thumbnailWorker = ThumbnailWorker(session.videos, parent=self)
+        self.thumbnailWorker.loaded.connect(self.thumbnailGrid.set_thumbnail)
+        self.thumbnailWorker.loaded.connect(self.thumbnail_loaded)
+        self.thumbnailWorker.failed.connect(self.thumbnailGrid.set_failed)
+        self.thumbnailWorker.start(QtCore.QThread.LowPriority)
+        self.videofile = None
+        # opens the first video through select_video
+        self.thumbnailGrid.setCurrentRow(0)
+
+    @Slot(str, object)
+    def thumbnail_loaded(self, videofile: str, info: dict):
+        if self.session is not None:
+            self.session.set_info(videofile, **info)
+
+    def stop_thumbnails(self):
+        if self.thumbnailWorker is None:
+            return
+        self.thumbnailWorker.requestInterruption()
+        self.thumbnailWorker.wait()
+        self.thumbnailWorker = None
+
+    @Slot(str)
+    def select_video(self, videofile: str):
+        if self.session is None or videofile == self.videofile:
+            return
+        self.save_roi()
+        try:
+            reader = self.session.readers.get(videofile)
+        except Exception as e:
+            print('Error opening video: {}'.format(e))
+            return
+        if not self.initialize_video(videofile, reader=reader):
+            return
+        self.session.set_info(videofile, self.videoPlayer.videoView.frame.shape[:2], len(reader))
+        if videofile in self.session.rois:
+            self.overlay.show_rect(*self.session.rois[videofile])
+
+    def save_roi(self):
+        """Remembers the ROI drawn on the current video, if it belongs to the open folder"""
+        if self.session is None or self.videofile not in self.session.videos:
+            return
+        roi = self.overlay.get_rect_coords() if self.overlay.has_rect else None
+        self.session.set_roi(self.videofile, roi)
+        self.thumbnailGrid.set_has_roi(self.videofile, roi is not None)
+
+    def copy_roi(self):
+        if self.session is None or not self.overlay.has_rect:
+            return
+        self.save_roi()
+        changed = self.session.copy_roi(self.videofile)
+        for videofile in changed:
+            self.thumbnailGrid.set_has_roi(videofile, True)
+        self.statusBar().showMessage('Copied ROI to {} videos'.format(len(changed)), 5000)
+
+    def crop_all(self):
+        if self.session is None:
+            return
+        self.save_roi()
+        movie_formats = self.toolbar.selected_formats()
+        if len(movie_formats) == 0:
+            QMessageBox.warning(self, 'No format selected', 'Select at least one output format')
+            return
+        kwargs = dict(movie_formats=movie_formats, scale=self.toolbar.scaleSpinBox.value(),
+                      grayscale=self.toolbar.grayscaleCheckBox.isChecked())
+        if len(self.session.jobs(**kwargs)) == 0:
+            QMessageBox.warning(self, 'No ROIs', 'Draw an ROI on at least one video')
+            return
+        queue_dir = os.path.join(self.session.directory, 'crop_queue')
+        names = self.session.submit(queue_dir, **kwargs)
+        args = ['python', '-m', 'video_cropper.workqueue', 'worker', queue_dir, '--exit_when_empty']
+        log.info('queued {} jobs in {}. args for subprocess call: {}'.format(len(names), queue_dir, args))
+        subprocess.Popen(args)
+        QMessageBox.information(self, 'Cropping', 'Queued {} videos in {}. Progress: python -m video_cropper.workqueue '
+                                                  'status {}'.format(len(names), queue_dir, queue_dir))
+
+    def initialize_video(self, videofile: Union[str, os.PathLike], reader=None):
+        if hasattr(self, 'vid') and self.videoPlayer.videoView.owns_reader:
             self.vid.close()
             # if hasattr(self.vid, 'cap'):
             #     self.vid.cap.release()
 
         self.videofile = videofile
         try:
-            self.videoPlayer.videoView.initialize_video(videofile)
+            self.videoPlayer.videoView.initialize_video(videofile, reader=reader)
             # for convenience extract the videoplayer object out of the videoView
             self.vid = self.videoPlayer.videoView.vid
             # for convenience
@@ -94,11 +228,13 @@ class MainWindow(QMainWindow):
             # get rid of previous info
             self.overlay.clear_rect()
             self.toolbar.clear_text()
+            self.videoPlayer.start_activity(videofile)
         except BaseException as e:
             print('Error initializing video: {}'.format(e))
             tb = traceback.format_exc()
             print(tb)
-            return
+            return False
+        return True
 
     def crop_video(self):
         if self.videofile is None:
@@ -117,24 +253,63 @@ class MainWindow(QMainWindow):
         # outfile, ext = os.path.splitext(filename) # ignore what user put in
         # outfile = pathlib.Path(filename)
         # outfile = outfile.with_suffix('')
-        selected_format = self.toolbar.exportFormat.currentText()
-        movie_format = self.toolbar.formats[selected_format]
+        movie_formats = self.toolbar.selected_formats()
+        if len(movie_formats) == 0:
+            QMessageBox.warning(self, 'No format selected', 'Select at least one output format')
+            return
 
         x, y, w, h = self.overlay.get_rect_coords()
         x, y, w, h = int(x), int(y), int(w), int(h)
-        if movie_format == 'ffmpeg':
+        if any(i in even_formats for i in movie_formats):
             w, h = self.make_even(x, y, w, h)
         log.info('filename: {}'.format(filename))
         args = ['python', '-m', 'video_cropper.crop', '-i', self.videofile, '-o', filename,
-                         '-x', str(x), '-y', str(y), '-w', str(w), '--height', str(h), '--movie_format', movie_format]
+                         '-x', str(x), '-y', str(y), '-w', str(w), '--height', str(h),
+                         '--movie_format'] + movie_formats + ['--scale', str(self.toolbar.scaleSpinBox.value())]
+        if self.toolbar.grayscaleCheckBox.isChecked():
+            args.append('--grayscale')
         log.info('args for subprocess call: {}'.format(args))
         subprocess.Popen(args)
         # crop_video(self.videofile, filename, x, y, w, h, movie_format=movie_format)
 
+    def estimate(self):
+        if self.videofile is None or not self.overlay.has_rect:
+            return
+        x, y, w, h = self.overlay.get_rect_coords()
+        # every format, so you can pick one
+        self.estimateWorker = EstimateWorker(self.videofile, int(x), int(y), int(w), int(h),
+                                             list(self.toolbar.formats.values()),
+                                             self.toolbar.scaleSpinBox.value(),
+                                             self.toolbar.grayscaleCheckBox.isChecked(), parent=self)
+        self.estimateWorker.estimated.connect(self.show_estimate)
+        self.toolbar.estimateButton.setEnabled(False)
+        self.estimateWorker.start()
+
+    @Slot(str)
+    def show_estimate(self, text: str):
+        self.toolbar.estimateButton.setEnabled(True)
+        log.info(text)
+        QMessageBox.information(self, 'Estimated time and size', text)
+
+    def stop_estimate(self):
+        if self.estimateWorker is None:
+            return
+        self.estimateWorker.requestInterruption()
+        self.estimateWorker.wait()
+        self.estimateWorker = None
+
+    def closeEvent(self, event):
+        self.videoPlayer.stop_activity()
+        self.stop_thumbnails()
+        self.stop_estimate()
+        if self.session is not None:
+            self.session.close()
+        super().closeEvent(event)
+
     def make_even(self, x,y,w,h):
         if (w % 2) == 0 and (h % 2) == 0:
             return w, h
-        warnings.warn('with ffmpeg, width and height must be even. adjusting...')
+        warnings.warn('with ffmpeg or opencv, width and height must be even. adjusting...')
         imw, imh = self.overlay.w, self.overlay.h
 
         max_y = y + h + 1
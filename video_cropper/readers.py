@@ -0,0 +1,289 @@
+import bisect
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+import cv2
+import h5py
+import numpy as np
+from vidio import VideoReader
+from vidio.read import DirectoryReader
+
+
+def decode_frame(encoded: np.ndarray) -> np.ndarray:
+    # unlike vidio's HDF5Reader, keep 1-channel and 16-bit images as they are. color images come out the same.
+    # OpenCV releases the GIL while decoding
+    return cv2.imdecode(encoded, cv2.IMREAD_UNCHANGED)
+
+
+class ImageFolderReader(DirectoryReader):
+    """vidio's DirectoryReader, but keeps 1-channel and 16-bit images as they are, and has an fps"""
+
+    def __init__(self, filename: Union[str, os.PathLike], fps: float = 30, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.filename = filename
+        self.fps = fps
+
+    def process_frame(self, frame):
+        if frame.ndim == 3 and frame.shape[2] == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        elif frame.ndim == 3 and frame.shape[2] == 4:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2RGBA)
+        return frame
+
+    def read(self, framenum: Union[int, slice]) -> Union[np.ndarray, list]:
+        if type(framenum) == slice:
+            return [self.read(i) for i in range(self.nframes)[framenum]]
+        if framenum < 0 or framenum >= self.nframes:
+            raise ValueError('frame number requested outside video bounds: {}'.format(framenum))
+        frame = cv2.imread(self.file_object[framenum], cv2.IMREAD_UNCHANGED)
+        if frame is None:
+            raise ValueError('Error reading image file {}'.format(self.file_object[framenum]))
+        self.fnum = framenum + 1
+        return self.process_frame(frame)
+
+    def __next__(self):
+        if self.fnum >= self.nframes:
+            raise StopIteration
+        return self.read(self.fnum)
+
+
+class HDF5BatchReader:
+    """Fast reader for vidio's HDF5 files of encoded images.
+
+    Instead of one h5py call and one decode per frame, encoded frames are read in blocks of block_size on a background
+    thread, and decoded on a pool of num_workers threads. Blocks don't cross chunk boundaries where possible: they are a
+    whole number of small chunks, or an even part of a large one (vidio and ImageHDF5Writer use 1024-frame chunks, so
+    a quarter chunk), which bounds memory and the cost of a random read. Sequential reads keep the next block and the
+    next decode_ahead frames in flight, so iterating is limited by disk and decode throughput rather than per-frame
+    Python overhead. Random reads read the requested frame's block, but only decode that frame.
+
+    Has the same interface as vidio's readers: iteration, indexing, len(), nframes, fps and fnum.
+    """
+
+    def __init__(self, filename: Union[str, os.PathLike], block_size: int = None, num_workers: int = None,
+                 decode_ahead: int = None):
+        assert os.path.isfile(filename)
+        self.filename = filename
+        self.file_object = h5py.File(filename, 'r')
+        self.dataset = self.file_object['frame']
+        self.nframes = len(self.dataset)
+        # vidio's HDF5Writer doesn't store fps. use its default unless someone saved it
+        self.fps = float(self.file_object.attrs.get('fps', self.dataset.attrs.get('fps', 30)))
+        self.block_size = self.default_block_size(self.dataset) if block_size is None else int(block_size)
+        self.num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+        self.decode_ahead = decode_ahead if decode_ahead is not None else 2 * self.num_workers
+
+        # h5py serializes all calls anyway, so one thread does the reading
+        self.io_pool = ThreadPoolExecutor(1)
+        self.decode_pool = ThreadPoolExecutor(self.num_workers)
+        # block index -> future of an object array of encoded frames: the blocks spanned by the decode window, plus
+        # the one being prefetched
+        self.blocks = OrderedDict()
+        self.max_blocks = 2 + int(np.ceil(self.decode_ahead / self.block_size))
+        # frame number -> future of the decoded frame
+        self.frames = {}
+        self.fnum = 0
+
+    @staticmethod
+    def default_block_size(dataset, min_frames: int = 64, max_frames: int = 256) -> int:
+        chunk = dataset.chunks[0] if dataset.chunks is not None else 1
+        if chunk > max_frames:
+            # large chunks are read in equal pieces to bound memory: the largest divisor of chunk up to max_frames,
+            # unless that's too small to be worth it (e.g. a prime chunk size)
+            piece = max(i for i in range(1, max_frames + 1) if chunk % i == 0)
+            return piece if piece >= min_frames else max_frames
+        return min(chunk * int(np.ceil(min_frames / chunk)), chunk * (max_frames // chunk))
+
+    def read_block(self, block: int) -> np.ndarray:
+        start = block * self.block_size
+        return self.dataset[start:min(start + self.block_size, self.nframes)]
+
+    def get_block(self, block: int):
+        if block in self.blocks:
+            self.blocks.move_to_end(block)
+            return self.blocks[block]
+        while len(self.blocks) >= self.max_blocks:
+            _, future = self.blocks.popitem(last=False)
+            future.cancel()
+        future = self.io_pool.submit(self.read_block, block)
+        self.blocks[block] = future
+        return future
+
+    def submit_decode(self, framenum: int):
+        if framenum in self.frames:
+            return
+        block = framenum // self.block_size
+        encoded = self.get_block(block).result()[framenum - block * self.block_size]
+        self.frames[framenum] = self.decode_pool.submit(decode_frame, encoded)
+
+    def read(self, framenum: Union[int, slice]) -> Union[np.ndarray, list]:
+        if type(framenum) == slice:
+            return [self.read(i) for i in range(self.nframes)[framenum]]
+        if framenum < 0 or framenum >= self.nframes:
+            raise ValueError('frame number requested outside video bounds: {}'.format(framenum))
+        sequential = framenum == self.fnum
+        last = min(framenum + self.decode_ahead, self.nframes - 1) if sequential else framenum
+
+        # drop anything we've already passed or won't need, e.g. after a seek
+        for i in list(self.frames.keys()):
+            if i < framenum or i > last:
+                self.frames.pop(i).cancel()
+        self.submit_decode(framenum)
+        if sequential:
+            next_block = last // self.block_size + 1
+            if next_block * self.block_size < self.nframes:
+                self.get_block(next_block)
+            for i in range(framenum + 1, last + 1):
+                self.submit_decode(i)
+
+        frame = self.frames.pop(framenum).result()
+        if frame is None:
+            raise ValueError('error decoding frame {} from file {}'.format(framenum, self.filename))
+        self.fnum = framenum + 1
+        return frame
+
+    def __getitem__(self, framenum: Union[int, slice]) -> Union[np.ndarray, list]:
+        return self.read(framenum)
+
+    def __len__(self):
+        return self.nframes
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.fnum >= self.nframes:
+            raise StopIteration
+        return self.read(self.fnum)
+
+    def close(self):
+        if not hasattr(self, 'file_object') or self.file_object is None:
+            return
+        for future in list(self.frames.values()) + list(self.blocks.values()):
+            future.cancel()
+        self.frames.clear()
+        self.blocks.clear()
+        self.decode_pool.shutdown(wait=True)
+        self.io_pool.shutdown(wait=True)
+        self.file_object.close()
+        self.file_object = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class ReaderPool:
+    """Opens readers on first use, and keeps at most max_open of them, closing the least recently used"""
+
+    def __init__(self, max_open: int = 4):
+        self.max_open = max_open
+        self.readers = OrderedDict()
+
+    def get(self, videofile: Union[str, os.PathLike]):
+        videofile = str(videofile)
+        if videofile in self.readers:
+            self.readers.move_to_end(videofile)
+            return self.readers[videofile]
+        while len(self.readers) >= self.max_open:
+            _, reader = self.readers.popitem(last=False)
+            reader.close()
+        reader = open_video(videofile)
+        self.readers[videofile] = reader
+        return reader
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+
+
+class ShardedReader:
+    """Reads a set of shards written by writers.ShardedWriter as one logical video.
+
+    Has the same interface as vidio's readers: iteration, indexing, len(), nframes, fps and fnum. Shards are opened
+    lazily, and at most max_open of them are kept open at once (least recently used are closed first).
+
+    Example:
+        with ShardedReader('movie.mp4.shards.json') as reader:
+            frame = reader[12345]
+    """
+
+    def __init__(self, index_file: Union[str, os.PathLike], max_open: int = 4):
+        self.index_file = str(index_file)
+        with open(self.index_file, 'r') as f:
+            self.index = json.load(f)
+        directory = os.path.dirname(os.path.abspath(self.index_file))
+        self.filenames = [os.path.join(directory, shard['filename']) for shard in self.index['shards']]
+        self.starts = [shard['start'] for shard in self.index['shards']]
+        self.nframes = self.index['nframes']
+        self.fps = self.index.get('fps') or 30
+        self.readers = ReaderPool(max_open)
+        self.fnum = 0
+
+    def shard_of(self, framenum: int):
+        """Maps a global frame number to (shard, local frame number)"""
+        if framenum < 0 or framenum >= self.nframes:
+            raise ValueError('frame number requested outside video bounds: {}'.format(framenum))
+        shard = bisect.bisect_right(self.starts, framenum) - 1
+        return shard, framenum - self.starts[shard]
+
+    def get_reader(self, shard: int):
+        return self.readers.get(self.filenames[shard])
+
+    def read(self, framenum: Union[int, slice]) -> Union[np.ndarray, list]:
+        if type(framenum) == slice:
+            return [self.read(i) for i in range(self.nframes)[framenum]]
+        shard, local = self.shard_of(framenum)
+        frame = self.get_reader(shard)[local]
+        self.fnum = framenum + 1
+        return frame
+
+    def __getitem__(self, framenum: Union[int, slice]) -> Union[np.ndarray, list]:
+        return self.read(framenum)
+
+    def __len__(self):
+        return self.nframes
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.fnum >= self.nframes:
+            raise StopIteration
+        return self.read(self.fnum)
+
+    def close(self):
+        if not hasattr(self, 'readers'):
+            return
+        self.readers.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+def open_video(filename: Union[str, os.PathLike]):
+    """Opens any supported video: shard indices written by this package, HDF5 files with the batched reader, image
+    folders keeping their bit depth, otherwise whatever vidio can read"""
+    if str(filename).endswith('.shards.json'):
+        return ShardedReader(filename)
+    _, ext = os.path.splitext(str(filename))
+    if os.path.isfile(filename) and ext.lower() in ['.h5', '.hdf5']:
+        return HDF5BatchReader(filename)
+    if os.path.isdir(filename):
+        return ImageFolderReader(filename)
+    return VideoReader(filename)
@@ -0,0 +1,129 @@
+import json
+import os
+from typing import Union, Sequence
+
+import cv2
+import numpy as np
+
+from .bitdepth import apply_lut, dtype_range, make_lut
+from .readers import ReaderPool, open_video
+from .workqueue import WorkQueue
+
+video_extensions = ['.h5', '.hdf5', '.avi', '.mp4', '.mov']
+
+
+def find_videos(directory: Union[str, os.PathLike]) -> list:
+    """Videos and shard indices in a folder, sorted by name, leaving out the shards themselves. Not recursive"""
+    directory = str(directory)
+    names = sorted(os.listdir(directory))
+    shards = set()
+    for name in names:
+        if name.endswith('.shards.json'):
+            with open(os.path.join(directory, name), 'r') as f:
+                shards.update(shard['filename'] for shard in json.load(f)['shards'])
+    videos = []
+    for name in names:
+        path = os.path.join(directory, name)
+        if name in shards or not os.path.isfile(path):
+            continue
+        if name.endswith('.shards.json') or os.path.splitext(name)[1].lower() in video_extensions:
+            videos.append(path)
+    return videos
+
+
+def default_outfile(videofile: Union[str, os.PathLike]) -> str:
+    videofile = str(videofile)
+    if videofile.endswith('.shards.json'):
+        base = videofile[:-len('.shards.json')]
+        base = os.path.splitext(base)[0]
+    else:
+        base = os.path.splitext(videofile)[0]
+    return base + '_cropped'
+
+
+def load_thumbnail(videofile: Union[str, os.PathLike], width: int = 160) -> dict:
+    """Decodes the middle frame of a video, as an 8-bit thumbnail width pixels wide.
+
+    Returns:
+        dict with the thumbnail, the video's frame shape (height, width) and number of frames
+    """
+    reader = open_video(videofile)
+    try:
+        nframes = len(reader)
+        frame = reader[nframes // 2]
+    finally:
+        reader.close()
+    shape = tuple(int(i) for i in frame.shape[:2])
+    if frame.ndim == 3 and frame.shape[2] == 1:
+        frame = frame[..., 0]
+    if frame.dtype != np.uint8:
+        frame = apply_lut(frame, make_lut(*dtype_range(frame), in_dtype=frame.dtype))
+    height = max(int(round(shape[0] * width / shape[1])), 1)
+    thumbnail = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    return {'thumbnail': np.ascontiguousarray(thumbnail), 'shape': shape, 'nframes': nframes}
+
+
+class Session:
+    """A folder of videos, each with its frame shape and its ROI (x, y, w, h), for setting up many crops at once.
+
+    Shapes are filled in as thumbnails load (set_info). ROIs can be copied to every video with the same shape, and
+    all videos with an ROI are submitted to a WorkQueue in one step.
+
+    Example:
+        session = Session('/data/2020_01_20')
+        for video in session.videos:
+            session.set_info(video, **load_thumbnail(video))
+        session.set_roi(session.videos[0], (100, 50, 400, 300))
+        session.copy_roi(session.videos[0])
+        session.submit('/data/2020_01_20/crop_queue', movie_formats=['ffmpeg'])
+    """
+
+    def __init__(self, directory: Union[str, os.PathLike], max_open: int = 4):
+        self.directory = str(directory)
+        self.videos = find_videos(self.directory)
+        self.shapes = {}
+        self.nframes = {}
+        self.rois = {}
+        self.readers = ReaderPool(max_open)
+
+    def set_info(self, videofile: str, shape: tuple, nframes: int, **kwargs):
+        self.shapes[videofile] = tuple(shape)
+        self.nframes[videofile] = nframes
+
+    def set_roi(self, videofile: str, roi: Union[tuple, None]):
+        if roi is None:
+            self.rois.pop(videofile, None)
+        else:
+            self.rois[videofile] = tuple(int(i) for i in roi)
+
+    def copy_roi(self, videofile: str) -> list:
+        """Gives every video with the same frame shape the ROI of videofile. Returns the videos that changed"""
+        if videofile not in self.rois or videofile not in self.shapes:
+            return []
+        changed = []
+        for video in self.videos:
+            if video != videofile and self.shapes.get(video) == self.shapes[videofile]:
+                if self.rois.get(video) != self.rois[videofile]:
+                    self.rois[video] = self.rois[videofile]
+                    changed.append(video)
+        return changed
+
+    def jobs(self, movie_formats: Sequence[str] = ('ffmpeg',), scale: int = 1, grayscale: bool = False) -> list:
+        """crop_video arguments for every video with an ROI"""
+        jobs = []
+        for video in self.videos:
+            if video not in self.rois:
+                continue
+            x, y, w, h = self.rois[video]
+            jobs.append({'infile': os.path.abspath(video), 'outfile': os.path.abspath(default_outfile(video)),
+                         'x': x, 'y': y, 'w': w, 'h': h, 'movie_format': list(movie_formats), 'scale': scale,
+                         'grayscale': grayscale})
+        return jobs
+
+    def submit(self, queue_dir: Union[str, os.PathLike], **kwargs) -> list:
+        """Submits jobs(**kwargs) to a WorkQueue. Returns the job names"""
+        queue = WorkQueue(queue_dir)
+        return [queue.submit(job) for job in self.jobs(**kwargs)]
+
+    def close(self):
+        self.readers.close()
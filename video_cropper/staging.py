@@ -0,0 +1,302 @@
+"""Stages videos on slow network storage through local scratch space while cropping them in batches.
+
+While one video is cropped, the next few are copied to scratch with large reads on a pool of threads, which is much
+faster over NFS than the small, latency-bound sequential reads of a video decoder. Each crop is written to scratch too,
+and moved to its destination in the background once it finishes. Staged inputs and finished outputs waiting to be
+moved share a budget of scratch space.
+
+Example:
+    with Stager('/scratch/me', budget_bytes=200e9) as stager:
+        for i, job in enumerate(jobs):
+            upcoming = [j['infile'] for j in jobs[i + 1:]]
+            result = stager.crop(upcoming=upcoming, **job)
+        print(stager.stats)
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Lock
+from typing import Callable, Union, Sequence
+
+from .crop import crop_video
+from .readers import open_video
+
+log = logging.getLogger(__name__)
+
+
+def source_files(path: Union[str, os.PathLike], name: str = None) -> list:
+    """Every file a video consists of, as (path, name relative to the staged copy).
+
+    A file, every file in an image folder, or a shard index plus its shards (which are named relative to the index)
+    """
+    path = str(path).rstrip('/\\')
+    name = os.path.basename(path) if name is None else name
+    if os.path.isdir(path):
+        return [(os.path.join(path, i), os.path.join(name, i)) for i in sorted(os.listdir(path))
+                if os.path.isfile(os.path.join(path, i))]
+    files = [(path, name)]
+    if path.endswith('.shards.json'):
+        directory = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r') as f:
+            for shard in json.load(f)['shards']:
+                files += source_files(os.path.join(directory, shard['filename']), shard['filename'])
+    return files
+
+
+def copy_file(src: str, dst: str, pool: ThreadPoolExecutor, block_size: int):
+    """Copies one file with concurrent block_size reads at different offsets"""
+    size = os.path.getsize(src)
+    if not hasattr(os, 'pread'):
+        shutil.copyfile(src, dst)
+        return
+    fin = os.open(src, os.O_RDONLY)
+    try:
+        fout = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fout, size)
+
+            def copy_block(offset):
+                data = os.pread(fin, block_size, offset)
+                os.pwrite(fout, data, offset)
+
+            for future in [pool.submit(copy_block, offset) for offset in range(0, size, block_size)]:
+                future.result()
+        finally:
+            os.close(fout)
+    finally:
+        os.close(fin)
+
+
+def seconds_per_frame(path: str, n: int) -> float:
+    """Time to read the first n frames of a video sequentially, per frame"""
+    reader = open_video(path)
+    try:
+        n = min(n, len(reader))
+        t0 = time.perf_counter()
+        for i in range(n):
+            reader[i]
+        return (time.perf_counter() - t0) / max(n, 1)
+    finally:
+        reader.close()
+
+
+def move_outputs(outdir: str, names: Sequence[str], destination: str):
+    """Moves names from outdir into destination, replacing existing outputs like crop_video does, and removes outdir"""
+    os.makedirs(destination, exist_ok=True)
+    for name in names:
+        dst = os.path.join(destination, name)
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        elif os.path.exists(dst):
+            os.remove(dst)
+        shutil.move(os.path.join(outdir, name), dst)
+    os.rmdir(outdir)
+
+
+def relocate_result(result: dict, destination: str):
+    """Points the output paths of a crop_video result, including its verification records, into destination"""
+    result['outputs'] = [os.path.join(destination, os.path.basename(i)) for i in result['outputs']]
+    for verification in result.get('verification', []):
+        verification['output'] = os.path.join(destination, os.path.basename(verification['output']))
+
+
+class Stager:
+    """Prefetches inputs to local scratch, crops from there, and moves outputs to their destination in the background.
+
+    Everything lives in a fresh directory under scratch_dir, which is removed by close(), along with anything left
+    over from failed crops. Inputs that don't fit in budget_bytes (default: 80% of the free space in scratch_dir) are
+    read in place.
+
+    To estimate the time saved, the first probe_frames frames of each input are read in place before copying it. A
+    crop reading in place is assumed to take at least that long per frame, and at least as long as the crop from
+    scratch measured by crop_video; the difference, minus the time spent waiting for staging, is the estimate. stats
+    accumulates, over all crops: bytes staged, seconds spent copying, seconds crops waited for their input to be
+    staged, seconds spent moving outputs, and the estimated seconds saved vs. reading in place.
+    """
+
+    def __init__(self, scratch_dir: Union[str, os.PathLike], budget_bytes: float = None, prefetch: int = 2,
+                 block_size: int = 16 * 1024 * 1024, num_threads: int = 8, probe_frames: int = 32):
+        os.makedirs(scratch_dir, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='video_cropper_', dir=scratch_dir)
+        self.budget_bytes = 0.8 * shutil.disk_usage(self.directory).free if budget_bytes is None else budget_bytes
+        self.prefetch_count = prefetch
+        self.block_size = block_size
+        self.probe_frames = probe_frames
+
+        self.io_pool = ThreadPoolExecutor(num_threads)
+        # one input is staged at a time, in order, so the next one is ready first
+        self.stage_pool = ThreadPoolExecutor(1)
+        self.move_pool = ThreadPoolExecutor(1)
+        self.lock = Lock()
+        # infile -> (bytes reserved, future of the staging result)
+        self.staged = {}
+        self.used_bytes = 0
+        self.counter = count()
+        self.moves = []
+        self.stats = {'crops': 0, 'staged_bytes': 0, 'copy_seconds': 0.0, 'wait_seconds': 0.0, 'move_seconds': 0.0,
+                      'saved_seconds': 0.0}
+
+    def reserve(self, nbytes: int) -> bool:
+        with self.lock:
+            if self.used_bytes + nbytes > self.budget_bytes:
+                return False
+            self.used_bytes += nbytes
+            return True
+
+    def free(self, nbytes: int):
+        with self.lock:
+            self.used_bytes -= nbytes
+
+    def stage(self, infile: str, files: list, index: int) -> dict:
+        in_place = seconds_per_frame(infile, self.probe_frames)
+        directory = os.path.join(self.directory, 'in{:05d}'.format(index))
+        t0 = time.perf_counter()
+        try:
+            for src, name in files:
+                dst = os.path.join(directory, name)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                copy_file(src, dst, self.io_pool, self.block_size)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        copy_seconds = time.perf_counter() - t0
+        path = os.path.join(directory, files[0][1].split(os.sep)[0])
+        return {'path': path, 'directory': directory, 'copy_seconds': copy_seconds, 'in_place': in_place}
+
+    def prefetch(self, infiles: Sequence[str]):
+        """Starts staging infiles in order, as far as the budget allows. Staged inputs not in infiles are dropped"""
+        infiles = [str(i) for i in infiles]
+        for infile in list(self.staged.keys()):
+            if infile not in infiles:
+                self.drop(infile)
+        for infile in infiles:
+            if infile in self.staged:
+                continue
+            files = source_files(infile)
+            nbytes = sum(os.path.getsize(src) for src, _ in files)
+            if not self.reserve(nbytes):
+                break
+            future = self.stage_pool.submit(self.stage, infile, files, next(self.counter))
+            self.staged[infile] = (nbytes, future)
+
+    def drop(self, infile: str):
+        nbytes, future = self.staged.pop(infile)
+
+        def cleanup(future):
+            if not future.cancelled() and future.exception() is None:
+                shutil.rmtree(future.result()['directory'], ignore_errors=True)
+            self.free(nbytes)
+
+        # cleans up now if it's finished or cancelled, otherwise once staging finishes
+        future.cancel()
+        future.add_done_callback(cleanup)
+
+    def crop(self, infile: Union[str, os.PathLike], outfile: Union[str, os.PathLike], *args,
+             upcoming: Sequence[Union[str, os.PathLike]] = (), should_move: Callable[[], bool] = None,
+             **kwargs) -> dict:
+        """crop_video via scratch. Also starts staging the upcoming inputs.
+
+        If should_move is given, it is called on the move thread just before the outputs are moved, and they are
+        discarded instead if it returns False (e.g. a work queue job whose lease was taken by another worker).
+
+        Returns:
+            crop_video's result, with outputs at their destination, 'staging' stats for this crop, and 'moved': a
+            Future of whether the outputs were moved to their destination (raising if moving them failed)
+        """
+        infile, outfile = str(infile), str(outfile)
+        self.prefetch([infile] + [str(i) for i in upcoming][:self.prefetch_count])
+        staging = {'staged': False, 'bytes': 0, 'copy_seconds': 0.0, 'wait_seconds': 0.0, 'saved_seconds': 0.0}
+        source = infile
+        t0 = time.perf_counter()
+        if infile in self.staged:
+            nbytes, future = self.staged[infile]
+            try:
+                staged = future.result()
+            except Exception as e:
+                log.warning('could not stage {}, reading in place: {!r}'.format(infile, e))
+            else:
+                source = staged['path']
+                staging.update({'staged': True, 'bytes': nbytes, 'copy_seconds': staged['copy_seconds'],
+                                'in_place': staged['in_place']})
+        staging['wait_seconds'] = time.perf_counter() - t0
+
+        outdir = tempfile.mkdtemp(prefix='out', dir=self.directory)
+        try:
+            result = crop_video(source, os.path.join(outdir, os.path.basename(outfile.rstrip('/\\'))), *args,
+                                **kwargs)
+        except BaseException:
+            shutil.rmtree(outdir, ignore_errors=True)
+            raise
+        finally:
+            if infile in self.staged:
+                self.drop(infile)
+        if staging['staged']:
+            # the in-place probe is cold, like a crop in place would be. the crop from scratch was timed for real
+            in_place = max(staging['in_place'] * result['nframes'], result['seconds'])
+            staging['saved_seconds'] = in_place - result['seconds'] - staging['wait_seconds']
+
+        destination = os.path.dirname(os.path.abspath(outfile))
+        relocate_result(result, destination)
+        names = os.listdir(outdir)
+        nbytes = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(outdir) for f in files)
+        # outputs are already written, so they count against the budget even if it's exceeded
+        with self.lock:
+            self.used_bytes += nbytes
+        moved = self.move_pool.submit(self.move, outdir, names, destination, nbytes, should_move)
+        self.moves.append(moved)
+        result['staging'] = staging
+        result['moved'] = moved
+
+        self.stats['crops'] += 1
+        self.stats['staged_bytes'] += staging['bytes']
+        self.stats['copy_seconds'] += staging['copy_seconds']
+        self.stats['wait_seconds'] += staging['wait_seconds']
+        self.stats['saved_seconds'] += staging['saved_seconds']
+        log.info('cropped {}: staged {}, waited {:.1f} s for staging, saved an estimated {:.1f} s'.format(
+            infile, staging['staged'], staging['wait_seconds'], staging['saved_seconds']))
+        return result
+
+    def move(self, outdir: str, names: list, destination: str, nbytes: int,
+             should_move: Callable[[], bool] = None) -> bool:
+        if should_move is not None and not should_move():
+            log.warning('discarding outputs for {}'.format(destination))
+            shutil.rmtree(outdir, ignore_errors=True)
+            self.free(nbytes)
+            return False
+        t0 = time.perf_counter()
+        try:
+            move_outputs(outdir, names, destination)
+        except Exception as e:
+            log.error('could not move outputs to {}, leaving them in {}: {!r}'.format(destination, outdir, e))
+            raise
+        else:
+            self.free(nbytes)
+        finally:
+            self.stats['move_seconds'] += time.perf_counter() - t0
+        return True
+
+    def close(self):
+        """Waits for outputs to be moved and removes scratch. If a move failed, keeps its outputs and raises"""
+        for future in list(self.staged.values()):
+            future[1].cancel()
+        self.stage_pool.shutdown(wait=True)
+        self.move_pool.shutdown(wait=True)
+        self.io_pool.shutdown(wait=True)
+        failed = [future.exception() for future in self.moves if future.exception() is not None]
+        for infile in list(self.staged.keys()):
+            self.drop(infile)
+        if failed:
+            raise RuntimeError('{} outputs could not be moved from {}'.format(len(failed), self.directory)) \
+                from failed[0]
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import time
+from typing import Union, Sequence
+
+import cv2
+import h5py
+import numpy as np
+
+from .bitdepth import convert_dtype
+from .crop import CropTransform, make_even
+from .readers import open_video
+from .writers import checksum_filename, even_formats, extensions, frame_checksum, native_formats
+
+
+def output_format(filename: Union[str, os.PathLike]) -> str:
+    """Movie format of an output file, from its name (or its index, for shards)"""
+    filename = str(filename).rstrip('/\\')
+    if filename.endswith('.shards.json'):
+        with open(filename, 'r') as f:
+            return json.load(f)['movie_format']
+    if os.path.isdir(filename):
+        return 'directory'
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.hdf5':
+        return 'hdf5'
+    for movie_format, extension in extensions.items():
+        if extension != '' and ext == extension:
+            return movie_format
+    raise ValueError('Unknown output format: {}'.format(filename))
+
+
+def read_checksums(filename: Union[str, os.PathLike]) -> Union[list, None]:
+    """Per-frame checksums stored by the lossless writers, or None if the output has none"""
+    filename = str(filename).rstrip('/\\')
+    if filename.endswith('.shards.json'):
+        directory = os.path.dirname(os.path.abspath(filename))
+        with open(filename, 'r') as f:
+            shards = json.load(f)['shards']
+        checksums = []
+        for shard in shards:
+            shard_checksums = read_checksums(os.path.join(directory, shard['filename']))
+            if shard_checksums is None:
+                return None
+            checksums += shard_checksums
+        return checksums
+    if os.path.isdir(filename):
+        path = os.path.join(filename, checksum_filename)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read().split()
+    if output_format(filename) == 'hdf5':
+        with h5py.File(filename, 'r') as f:
+            return list(f['checksum'][:]) if 'checksum' in f else None
+    return None
+
+
+def sample_frames(nframes: int, n_samples: int, seed: int = None) -> np.ndarray:
+    """Stratified random sample: one random frame from each of n_samples equal parts of the video, plus the last"""
+    rng = np.random.default_rng(seed)
+    edges = np.linspace(0, nframes, min(n_samples, nframes) + 1).astype(int)
+    samples = [rng.integers(start, end) for start, end in zip(edges[:-1], edges[1:]) if end > start]
+    return np.unique(samples + [nframes - 1]) if nframes > 0 else np.zeros(0, dtype=int)
+
+
+def verify_crop(infile: Union[str, os.PathLike], outputs: Sequence[Union[str, os.PathLike]], x: int, y: int, w: int,
+                h: int, scale: int = 1, grayscale: bool = False, dtype: str = None, bit_depth: int = None,
+                nframes: int = None, n_samples: int = 16, tolerance: float = 10.0, relative_tolerance: float = None,
+                seed: int = None) -> list:
+    """Checks that outputs of crop_video match their source, reading only a few frames of each.
+
+    Each output must have nframes frames (default: the length of the source). A stratified random sample of frames
+    is cropped from the source, and compared with the same frames of each output: lossless outputs (hdf5, directory)
+    must be identical, and their stored per-frame checksums must match, while lossy outputs must have the same shape
+    and a mean absolute error of at most tolerance (on a 0-255 scale). Very detailed frames (e.g. noise) can't be
+    compressed that closely: with relative_tolerance, errors of up to that fraction of the frame's standard deviation
+    are also accepted (e.g. 0.5). Runtime depends on n_samples, not on the length of the video.
+
+    Returns:
+        a dict per output, with 'ok', 'errors' describing what didn't match, the largest error of a lossy output and
+        the tolerance it was held to, and the seconds spent checking that output
+    """
+    outputs = [str(i) for i in outputs]
+    movie_formats = [output_format(i) for i in outputs]
+    if any(i in even_formats for i in movie_formats):
+        # crop_video evens the crop for every output if one of them needs it
+        w, h = make_even(w, h, scale)
+    transform = CropTransform(x, y, w, h, scale=scale, grayscale=grayscale, dtype=dtype, bit_depth=bit_depth)
+
+    source = open_video(infile)
+    try:
+        nframes = len(source) if nframes is None else nframes
+        samples = sample_frames(min(nframes, len(source)), n_samples, seed)
+        expected = {int(i): transform(source[int(i)]).copy() for i in samples}
+    finally:
+        source.close()
+
+    results = []
+    for output, movie_format in zip(outputs, movie_formats):
+        t0 = time.perf_counter()
+        result = {'output': output, 'movie_format': movie_format, 'samples': [int(i) for i in samples], 'errors': []}
+        errors = result['errors']
+        reader = open_video(output)
+        try:
+            result['nframes'] = len(reader)
+            if len(reader) != nframes:
+                errors.append('expected {} frames, found {}'.format(nframes, len(reader)))
+            checksums = read_checksums(output) if movie_format in native_formats else None
+            if movie_format in native_formats and (checksums is None or len(checksums) != len(reader)):
+                errors.append('missing per-frame checksums')
+                checksums = None
+            max_error, max_tolerance = 0.0, tolerance
+            for i in samples:
+                if i >= len(reader):
+                    continue
+                frame, target = reader[int(i)], expected[int(i)]
+                if movie_format in native_formats:
+                    if frame.shape != target.shape or frame.dtype != target.dtype or not np.array_equal(frame, target):
+                        errors.append('frame {} differs from source'.format(i))
+                    elif checksums is not None and checksums[i] != frame_checksum(frame):
+                        errors.append('frame {} does not match its checksum'.format(i))
+                    continue
+                # lossy formats are 8-bit, and may come back with 3 channels
+                target = convert_dtype(target, np.uint8, bit_depth=bit_depth)
+                if target.ndim == 2 and frame.ndim == 3:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+                if frame.shape != target.shape:
+                    errors.append('frame {} has shape {}, expected {}'.format(i, frame.shape, target.shape))
+                    continue
+                error = float(cv2.absdiff(frame, target).mean())
+                allowed = tolerance
+                if relative_tolerance is not None:
+                    allowed = max(tolerance, relative_tolerance * float(target.std()))
+                max_error, max_tolerance = max(max_error, error), max(max_tolerance, allowed)
+                if error > allowed:
+                    errors.append('frame {} has mean absolute error {:.1f} (tolerance {:.1f})'.format(i, error,
+                                                                                                    allowed))
+            result['max_error'] = max_error
+            result['tolerance'] = max_tolerance
+        except Exception as e:
+            errors.append('could not read: {!r}'.format(e))
+        finally:
+            reader.close()
+        result['ok'] = len(errors) == 0
+        result['seconds'] = time.perf_counter() - t0
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check crop outputs against their source')
+    parser.add_argument('-i', '--infile', required=True, type=str)
+    parser.add_argument('-o', '--outputs', required=True, type=str, nargs='+',
+                        help='output files, image folders or shard indices of one crop')
+    parser.add_argument('-x', required=True, type=int)
+    parser.add_argument('-y', required=True, type=int)
+    parser.add_argument('-w', required=True, type=int)
+    parser.add_argument('--height', required=True, type=int)
+    parser.add_argument('--scale', default=1, type=int)
+    parser.add_argument('--grayscale', default=False, action='store_true')
+    parser.add_argument('--dtype', default=None, type=str, choices=['uint8', 'uint16'])
+    parser.add_argument('--bit_depth', default=None, type=int)
+    parser.add_argument('--n_samples', default=16, type=int, help='number of frames to compare')
+    parser.add_argument('--tolerance', default=10.0, type=float,
+                        help='maximum mean absolute error per frame of lossy outputs')
+    parser.add_argument('--relative_tolerance', default=None, type=float,
+                        help='also accept errors up to this fraction of the standard deviation of each frame. for '
+                             'very detailed or noisy video')
+    args = parser.parse_args()
+    results = verify_crop(args.infile, args.outputs, args.x, args.y, args.w, args.height, scale=args.scale,
+                          grayscale=args.grayscale, dtype=args.dtype, bit_depth=args.bit_depth,
+                          n_samples=args.n_samples, tolerance=args.tolerance,
+                          relative_tolerance=args.relative_tolerance)
+    for result in results:
+        print('{}: {}'.format(result['output'], 'ok' if result['ok'] else '; '.join(result['errors'])))
+    if not all(result['ok'] for result in results):
+        raise SystemExit(1)
@@ -0,0 +1,367 @@
+"""Work queue for running crop_video jobs on many machines that share a filesystem, with no scheduler.
+
+Layout of a queue directory:
+    pending/JOB.json            jobs waiting for a worker
+    running/JOB@WORKER.json     claimed jobs. the file itself is the lease: its worker touches it every heartbeat
+    done/JOB.json               job spec, plus the result and metrics of the crop
+    failed/JOB.json             job spec, plus the error of the last attempt
+    tmp/, clock/                scratch space for atomic writes, and for reading the file server's time
+
+Every state change is a rename, which is atomic on local filesystems and on NFS / Lustre, so exactly one worker wins
+each claim. A lease expires when its file's ctime (updated by both the claiming rename and each heartbeat, and set by
+the file server, so node clocks don't need to agree) is older than lease_timeout. Any worker then moves the job back
+to pending, or to failed after max_attempts. A worker whose lease was taken stops cropping and publishes nothing.
+
+Each attempt crops into its own hidden directory next to the destination (.OUTFILE.attempt-XXXX), and its outputs are
+only moved into place once it has succeeded and still holds its lease, so retries never trip over partial outputs of
+an earlier attempt, and a worker that lost its lease never overwrites the outputs of the job's new owner.
+
+With a scratch directory, a worker copies the inputs of the next few pending jobs to local disk while it crops, and
+writes its outputs there before moving them to their destination in the background (see staging.Stager). A job is
+only marked done once its outputs have arrived.
+
+Example, with several workers on one machine:
+    python -m video_cropper.workqueue submit /shared/queue -i a.mp4 -o a_cropped -x 0 -y 0 -w 200 --height 200
+    python -m video_cropper.workqueue worker /shared/queue --exit_when_empty &
+    python -m video_cropper.workqueue worker /shared/queue --exit_when_empty &
+    python -m video_cropper.workqueue status /shared/queue
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+import traceback
+import uuid
+from threading import Event, Thread
+from typing import Union
+
+from .crop import crop_video
+from .staging import Stager, move_outputs, relocate_result
+from .writers import disk_usage
+
+log = logging.getLogger(__name__)
+
+states = ['pending', 'running', 'done', 'failed', 'tmp', 'clock']
+
+
+def attempt_prefix(outfile: Union[str, os.PathLike]) -> str:
+    return '.{}.attempt-'.format(os.path.basename(str(outfile).rstrip('/\\')))
+
+
+def make_attempt_dir(outfile: Union[str, os.PathLike]) -> str:
+    """Fresh directory next to outfile for one attempt at a job, removing those left over from earlier attempts"""
+    destination = os.path.dirname(os.path.abspath(str(outfile)))
+    os.makedirs(destination, exist_ok=True)
+    prefix = attempt_prefix(outfile)
+    for name in os.listdir(destination):
+        if name.startswith(prefix):
+            shutil.rmtree(os.path.join(destination, name), ignore_errors=True)
+    return tempfile.mkdtemp(prefix=prefix, dir=destination)
+
+
+def make_worker_id() -> str:
+    return '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6]).replace('@', '_')
+
+
+class WorkQueue:
+    def __init__(self, root: Union[str, os.PathLike], lease_timeout: float = 120, max_attempts: int = 3):
+        self.root = str(root)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        for state in states:
+            os.makedirs(os.path.join(self.root, state), exist_ok=True)
+
+    def path(self, state: str, name: str = '') -> str:
+        return os.path.join(self.root, state, name)
+
+    def write_json(self, state: str, name: str, data: dict):
+        """Writes to tmp and renames into place, so readers never see a partial file"""
+        tmpfile = self.path('tmp', '{}.{}'.format(name, uuid.uuid4().hex))
+        with open(tmpfile, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmpfile, self.path(state, name))
+
+    @staticmethod
+    def read_json(filename: str) -> dict:
+        with open(filename, 'r') as f:
+            return json.load(f)
+
+    def now(self, worker_id: str) -> float:
+        """Current time according to the file server, by touching a file and reading it back"""
+        clockfile = self.path('clock', worker_id)
+        with open(clockfile, 'a'):
+            pass
+        os.utime(clockfile, None)
+        return os.stat(clockfile).st_mtime
+
+    def submit(self, args: dict, name: str = None) -> str:
+        """Adds a job. args are keyword arguments to crop_video. Returns the job name"""
+        if name is None:
+            base = os.path.splitext(os.path.basename(str(args['infile'])))[0]
+            name = '{}_{}_{}'.format(time.strftime('%y%m%d_%H%M%S'), base, uuid.uuid4().hex[:6])
+        if '@' in name:
+            raise ValueError('job names cannot contain @: {}'.format(name))
+        job = {'name': name, 'args': args, 'attempts': 0, 'submitted': time.time()}
+        self.write_json('pending', name + '.json', job)
+        return name
+
+    def claim(self, worker_id: str) -> Union[str, None]:
+        """Atomically moves one pending job to running. Returns the path of the lease file, or None if none left"""
+        for filename in sorted(os.listdir(self.path('pending'))):
+            if not filename.endswith('.json'):
+                continue
+            name = filename[:-len('.json')]
+            lease = self.path('running', '{}@{}.json'.format(name, worker_id))
+            try:
+                os.rename(self.path('pending', filename), lease)
+            except FileNotFoundError:
+                # another worker got there first
+                continue
+            return lease
+        return None
+
+    def release(self, lease: str, worker_id: str) -> Union[str, None]:
+        """Takes a lease out of running, so nobody else can reclaim it. Returns None if it was already taken"""
+        released = self.path('tmp', '{}.release.{}'.format(os.path.basename(lease), worker_id))
+        try:
+            os.rename(lease, released)
+        except FileNotFoundError:
+            return None
+        return released
+
+    def publish(self, lease: str, worker_id: str, state: str, job: dict) -> str:
+        """Moves a job from running to state with updated contents, if we still hold its lease"""
+        released = self.release(lease, worker_id)
+        if released is None:
+            log.warning('lost lease on {}, discarding'.format(job['name']))
+            return 'lost'
+        self.write_json(state, job['name'] + '.json', job)
+        os.remove(released)
+        return state
+
+    def requeue(self, lease: str, worker_id: str, job: dict, error: str) -> str:
+        """Moves a job whose attempt failed back to pending, or to failed if it has used up its attempts"""
+        job['attempts'] += 1
+        job['error'] = error
+        state = 'failed' if job['attempts'] >= self.max_attempts else 'pending'
+        return self.publish(lease, worker_id, state, job)
+
+    def reclaim_expired(self, worker_id: str) -> int:
+        """Requeues jobs whose worker stopped heartbeating. Returns how many were reclaimed"""
+        now = self.now(worker_id)
+        n = 0
+        for filename in os.listdir(self.path('running')):
+            lease = self.path('running', filename)
+            try:
+                stat = os.stat(lease)
+            except FileNotFoundError:
+                continue
+            if now - max(stat.st_ctime, stat.st_mtime) < self.lease_timeout:
+                continue
+            try:
+                job = self.read_json(lease)
+            except FileNotFoundError:
+                continue
+            # publishing renames the lease first, so only one worker reclaims it, and its old worker sees it's gone
+            state = self.requeue(lease, worker_id, job,
+                                 'lease expired: {}'.format(filename.split('@', 1)[-1][:-len('.json')]))
+            if state == 'lost':
+                continue
+            log.warning('reclaimed expired job {} -> {}'.format(job['name'], state))
+            n += 1
+        return n
+
+    def status(self) -> dict:
+        return {state: len([i for i in os.listdir(self.path(state)) if i.endswith('.json')])
+                for state in ['pending', 'running', 'done', 'failed']}
+
+    def upcoming(self, n: int) -> list:
+        """Inputs of the next n pending jobs"""
+        infiles = []
+        for filename in sorted(os.listdir(self.path('pending'))):
+            if len(infiles) >= n:
+                break
+            if not filename.endswith('.json'):
+                continue
+            try:
+                infiles.append(self.read_json(self.path('pending', filename))['args']['infile'])
+            except (FileNotFoundError, ValueError, KeyError):
+                continue
+        return infiles
+
+    def run_job(self, lease: str, worker_id: str, heartbeat: float, stager: Stager = None) -> str:
+        """Runs one claimed job while heartbeating its lease. Returns its final state.
+
+        With a stager, the crop goes through local scratch, and this returns 'moving' as soon as the crop is done. The
+        lease is kept until the outputs have been moved, then the job is published as usual.
+        """
+        job = self.read_json(lease)
+        lost = Event()
+        stopped = Event()
+
+        def beat():
+            while not stopped.wait(heartbeat):
+                try:
+                    os.utime(lease, None)
+                except FileNotFoundError:
+                    lost.set()
+                    return
+
+        thread = Thread(target=beat, daemon=True)
+        thread.start()
+        host = socket.gethostname()
+        started = time.time()
+
+        def stop():
+            stopped.set()
+            thread.join()
+
+        def holds_lease():
+            return not lost.is_set() and os.path.exists(lease)
+
+        outfile = str(job['args']['outfile']).rstrip('/\\')
+        destination = os.path.dirname(os.path.abspath(outfile))
+        attempt_dir = None
+        try:
+            if stager is None:
+                attempt_dir = make_attempt_dir(outfile)
+                args = dict(job['args'], outfile=os.path.join(attempt_dir, os.path.basename(outfile)))
+                result = crop_video(cancel=lost.is_set, **args)
+            else:
+                # the stager crops into its own scratch directory, and only moves outputs in while we hold the lease
+                upcoming = self.upcoming(stager.prefetch_count)
+                result = stager.crop(cancel=lost.is_set, upcoming=upcoming, should_move=holds_lease, **job['args'])
+        except Exception as e:
+            stop()
+            if attempt_dir is not None:
+                shutil.rmtree(attempt_dir, ignore_errors=True)
+            if lost.is_set():
+                log.warning('lost lease on {}, discarding'.format(job['name']))
+                return 'lost'
+            log.error('job {} failed: {!r}'.format(job['name'], e))
+            return self.requeue(lease, worker_id, job, traceback.format_exc())
+        except BaseException:
+            stop()
+            if attempt_dir is not None:
+                shutil.rmtree(attempt_dir, ignore_errors=True)
+            raise
+
+        def finish(moved=None):
+            stop()
+            if moved is not None and moved.exception() is not None:
+                log.error('job {} failed: {!r}'.format(job['name'], moved.exception()))
+                return self.requeue(lease, worker_id, job, 'moving outputs: {!r}'.format(moved.exception()))
+            if moved is not None and not moved.result():
+                log.warning('lost lease on {}, discarding'.format(job['name']))
+                return 'lost'
+            if attempt_dir is not None:
+                if not holds_lease():
+                    shutil.rmtree(attempt_dir, ignore_errors=True)
+                    log.warning('lost lease on {}, discarding'.format(job['name']))
+                    return 'lost'
+                try:
+                    move_outputs(attempt_dir, os.listdir(attempt_dir), destination)
+                except Exception as e:
+                    shutil.rmtree(attempt_dir, ignore_errors=True)
+                    log.error('job {} failed: {!r}'.format(job['name'], e))
+                    return self.requeue(lease, worker_id, job, 'moving outputs: {!r}'.format(e))
+                relocate_result(result, destination)
+            result['bytes'] = sum(disk_usage(i) for i in result['outputs'])
+            job['result'] = result
+            job['metrics'] = {'worker': worker_id, 'host': host, 'started': started, 'finished': time.time(),
+                              'attempt': job['attempts'] + 1}
+            return self.publish(lease, worker_id, 'done', job)
+
+        if stager is None:
+            return finish()
+        result.pop('moved').add_done_callback(finish)
+        return 'moving'
+
+    def work(self, worker_id: str = None, heartbeat: float = None, poll: float = 5, max_jobs: int = None,
+             exit_when_empty: bool = False, stager: Stager = None) -> int:
+        """Claims and runs jobs until stopped. Returns the number of jobs this worker finished cropping
+
+        Args:
+            heartbeat: seconds between lease touches. Default: a quarter of the lease timeout
+            poll: seconds to wait when there's nothing to do
+            max_jobs: stop after this many jobs
+            exit_when_empty: stop once nothing is pending or running
+            stager: crop through local scratch. Closed (waiting for outputs to be moved) before returning
+        """
+        worker_id = make_worker_id() if worker_id is None else worker_id
+        heartbeat = self.lease_timeout / 4 if heartbeat is None else heartbeat
+        n = 0
+        try:
+            while max_jobs is None or n < max_jobs:
+                self.reclaim_expired(worker_id)
+                lease = self.claim(worker_id)
+                if lease is None:
+                    status = self.status()
+                    if exit_when_empty and status['pending'] == 0 and status['running'] == 0:
+                        break
+                    time.sleep(poll)
+                    continue
+                log.info('{} running {}'.format(worker_id, os.path.basename(lease)))
+                if self.run_job(lease, worker_id, heartbeat, stager=stager) in ['done', 'moving']:
+                    n += 1
+        finally:
+            if stager is not None:
+                stager.close()
+                log.info('staging: {}'.format(stager.stats))
+        return n
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s %(name)-12s] %(levelname)-8s %(message)s', datefmt='%y%m%d_%H%M%S',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Shared-filesystem work queue for crop jobs')
+    subparsers = parser.add_subparsers(dest='command')
+    submit = subparsers.add_parser('submit', help='add a crop job')
+    worker = subparsers.add_parser('worker', help='run jobs')
+    status = subparsers.add_parser('status', help='count jobs in each state')
+    for subparser in [submit, worker, status]:
+        subparser.add_argument('root', type=str, help='queue directory, on a filesystem shared by all workers')
+    submit.add_argument('-i', '--infile', required=True, type=str)
+    submit.add_argument('-o', '--outfile', required=True, type=str)
+    submit.add_argument('-x', required=True, type=int)
+    submit.add_argument('-y', required=True, type=int)
+    submit.add_argument('-w', required=True, type=int)
+    submit.add_argument('--height', required=True, type=int)
+    submit.add_argument('--movie_format', default=['ffmpeg'], type=str, nargs='+')
+    submit.add_argument('--scale', default=1, type=int)
+    submit.add_argument('--grayscale', default=False, action='store_true')
+    submit.add_argument('--name', default=None, type=str, help='job name. default: time, input name and random id')
+    worker.add_argument('--lease_timeout', default=120, type=float,
+                        help='seconds without a heartbeat before a job is given to another worker')
+    worker.add_argument('--max_attempts', default=3, type=int)
+    worker.add_argument('--poll', default=5, type=float, help='seconds between checks for new jobs')
+    worker.add_argument('--max_jobs', default=None, type=int)
+    worker.add_argument('--exit_when_empty', default=False, action='store_true')
+    worker.add_argument('--scratch_dir', default=None, type=str,
+                        help='local directory to copy inputs to ahead of time and write outputs to')
+    worker.add_argument('--scratch_gb', default=None, type=float,
+                        help='scratch space budget. Default: 80%% of free space')
+    worker.add_argument('--prefetch', default=2, type=int, help='number of upcoming inputs to copy to scratch')
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        crop_args = {'infile': os.path.abspath(args.infile), 'outfile': os.path.abspath(args.outfile),
+                     'x': args.x, 'y': args.y, 'w': args.w, 'h': args.height, 'movie_format': args.movie_format,
+                     'scale': args.scale, 'grayscale': args.grayscale}
+        print(WorkQueue(args.root).submit(crop_args, name=args.name))
+    elif args.command == 'worker':
+        queue = WorkQueue(args.root, lease_timeout=args.lease_timeout, max_attempts=args.max_attempts)
+        stager = None
+        if args.scratch_dir is not None:
+            budget = None if args.scratch_gb is None else args.scratch_gb * 1e9
+            stager = Stager(args.scratch_dir, budget_bytes=budget, prefetch=args.prefetch)
+        n = queue.work(poll=args.poll, max_jobs=args.max_jobs, exit_when_empty=args.exit_when_empty, stager=stager)
+        log.info('finished {} jobs'.format(n))
+    elif args.command == 'status':
+        print(WorkQueue(args.root).status())
+    else:
+        parser.print_help()
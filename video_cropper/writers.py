@@ -0,0 +1,381 @@
+import hashlib
+import json
+import os
+import warnings
+from queue import Queue
+from threading import Thread
+from typing import Union, Sequence
+
+import cv2
+import h5py
+import numpy as np
+from vidio import VideoWriter
+
+from .bitdepth import convert_dtype
+
+# default file extension for each vidio movie format. directories have none
+extensions = {'ffmpeg': '.mp4',
+              'opencv': '.avi',
+              'hdf5': '.h5',
+              'directory': ''}
+
+
+# settings each format is encoded with. part of the result cache key, so change them here if they change
+encoder_settings = {'ffmpeg': {'vcodec': 'libx264', 'crf': 18, 'pix_fmt': 'yuv420p'},
+                    'opencv': {'codec': 'MJPG'},
+                    'hdf5': {'codec': '.png'},
+                    'directory': {'codec': '.png'}}
+
+# libx264 with yuv420p needs even dimensions, and OpenCV's MJPG silently drops an odd last row / column
+even_formats = ['ffmpeg', 'opencv']
+
+# per-frame checksums of image folders
+checksum_filename = 'checksums.txt'
+
+# formats we write ourselves so that 1-channel and 16-bit frames are stored as they are. the rest only take 8-bit
+native_formats = ['hdf5', 'directory']
+
+
+def frame_checksum(frame: np.ndarray) -> bytes:
+    """Hex digest of a frame's pixels, shape and dtype. Lossless writers store one per frame"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update('{}:{}:'.format(frame.shape, frame.dtype.str).encode())
+    h.update(np.ascontiguousarray(frame).data)
+    return h.hexdigest().encode()
+
+
+def encode_image(frame: np.ndarray, codec: str) -> np.ndarray:
+    if frame.ndim == 3 and frame.shape[2] == 1:
+        frame = frame[..., 0]
+    if frame.dtype == np.uint16 and codec in ['.jpg', '.jpeg', '.bmp']:
+        raise ValueError('{} does not support 16-bit images. Use .png or .tiff'.format(codec))
+    ret, encoded = cv2.imencode(codec, frame)
+    if not ret:
+        raise ValueError('error in encoding frame with shape {} and dtype {}'.format(frame.shape, frame.dtype))
+    return encoded.squeeze()
+
+
+class ImageHDF5Writer:
+    """Writes an HDF5 file of encoded images in the same layout as vidio's HDF5Writer, but keeps 1-channel and
+    16-bit frames as they are instead of expanding them to 3-channel uint8.
+
+    Like vidio, 3-channel frames are encoded without swapping to BGR, so that vidio's HDF5Reader reads them back as RGB.
+    Also stores fps as an attribute, and the frame_checksum of each frame in a 'checksum' dataset.
+    """
+
+    def __init__(self, filename: Union[str, os.PathLike], fps: float = 30, codec: str = '.png',
+                 in_colorspace: str = 'RGB', nframes: int = None, **kwargs):
+        filename = str(filename)
+        base, ext = os.path.splitext(filename)
+        if ext.lower() not in ['.h5', '.hdf5']:
+            warnings.warn('filename should end in .h5 or .hdf5 for HDF5 writing, not {}'.format(ext))
+            filename = base + '.h5'
+        assert in_colorspace in ['RGB', 'GRAY']
+        self.filename = filename
+        self.codec = codec
+        self.fps = fps
+        self.fnum = 0
+        self.file_object = h5py.File(self.filename, 'w')
+        self.file_object.attrs['fps'] = fps
+        datatype = h5py.special_dtype(vlen=np.dtype('uint8'))
+        self.dataset = self.file_object.create_dataset('frame', (nframes or 0,), maxshape=(None,), dtype=datatype,
+                                                       chunks=(1024,))
+        self.checksums = self.file_object.create_dataset('checksum', (nframes or 0,), maxshape=(None,), dtype='S32',
+                                                         chunks=(1024,))
+        self.has_stopped = False
+
+    def write(self, frame: np.ndarray):
+        # grow a chunk at a time rather than every frame. trimmed on close
+        if self.dataset.shape[0] <= self.fnum:
+            self.dataset.resize(self.dataset.shape[0] + self.dataset.chunks[0], axis=0)
+            self.checksums.resize(self.dataset.shape[0], axis=0)
+        self.dataset[self.fnum] = encode_image(frame, self.codec)
+        self.checksums[self.fnum] = frame_checksum(frame)
+        self.fnum += 1
+
+    def close(self):
+        if self.has_stopped:
+            return
+        self.has_stopped = True
+        self.dataset.resize(self.fnum, axis=0)
+        self.checksums.resize(self.fnum, axis=0)
+        self.file_object.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class ImageDirectoryWriter:
+    """Writes each frame as its own image in a new directory, like vidio's DirectoryWriter, but keeps 1-channel and
+    16-bit frames as they are. The frame_checksum of each frame is written to checksums.txt on close"""
+
+    def __init__(self, filename: Union[str, os.PathLike], codec: str = '.png', in_colorspace: str = 'RGB', **kwargs):
+        filename = str(filename)
+        base, ext = os.path.splitext(filename)
+        if ext != '':
+            warnings.warn('Directory writer called with filename input: {}'.format(filename))
+            filename = base
+        if os.path.isdir(filename) or os.path.isfile(filename):
+            raise ValueError('Directory already exists: {}'.format(filename))
+        assert in_colorspace in ['RGB', 'GRAY']
+        os.makedirs(filename)
+        self.filename = filename
+        self.codec = codec
+        self.fnum = 0
+        self.checksums = []
+
+    def write(self, frame: np.ndarray):
+        self.checksums.append(frame_checksum(frame))
+        # image files on disk should be BGR
+        if frame.ndim == 3 and frame.shape[2] == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        elif frame.ndim == 3 and frame.shape[2] == 4:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGRA)
+        encoded = encode_image(frame, self.codec)
+        with open(os.path.join(self.filename, '{:09d}{}'.format(self.fnum, self.codec)), 'wb') as f:
+            f.write(encoded.tobytes())
+        self.fnum += 1
+
+    def close(self):
+        with open(os.path.join(self.filename, checksum_filename), 'wb') as f:
+            f.write(b''.join(i + b'\n' for i in self.checksums))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def make_writer(filename: Union[str, os.PathLike], movie_format: str, **kwargs):
+    """Our native writers for formats that can store any bit depth, vidio's VideoWriter for the rest.
+
+    An existing output file is unlinked first rather than truncated in place, since it may be a hard link to a
+    ResultCache entry.
+    """
+    path = output_filename(filename, movie_format)
+    if movie_format != 'directory' and os.path.isfile(path):
+        os.remove(path)
+    if movie_format == 'hdf5':
+        return ImageHDF5Writer(filename, **kwargs)
+    elif movie_format == 'directory':
+        return ImageDirectoryWriter(filename, **kwargs)
+    return VideoWriter(filename, movie_format=movie_format, **kwargs)
+
+
+def output_filename(outfile: Union[str, os.PathLike], movie_format: str, strip_suffix: bool = False) -> str:
+    """Gets the filename that will be written for a given movie format.
+
+    If the outfile has no extension, adds the default one for movie_format. With strip_suffix, any known video
+    extension is replaced, which is used to derive several outputs from one name. Also applies the renaming the writers
+    would do: HDF5 files always end in .h5 or .hdf5, and image folders have no extension.
+    """
+    outfile = str(outfile)
+    base, ext = os.path.splitext(outfile)
+    if strip_suffix and ext.lower() in list(extensions.values()) + ['.hdf5', '.mov']:
+        outfile, ext = base, ''
+    if ext == '':
+        outfile += extensions.get(movie_format, '')
+    elif movie_format == 'hdf5' and ext.lower() not in ['.h5', '.hdf5']:
+        outfile = base + '.h5'
+    elif movie_format == 'directory':
+        outfile = base
+    return outfile
+
+
+def disk_usage(path: Union[str, os.PathLike]) -> int:
+    """Bytes used by a file, or by all files in a directory or referenced by a shard index"""
+    path = str(path)
+    if os.path.isdir(path):
+        return sum(disk_usage(os.path.join(path, i)) for i in os.listdir(path))
+    if not os.path.exists(path):
+        return 0
+    total = os.path.getsize(path)
+    if path.endswith('.shards.json'):
+        directory = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r') as f:
+            total += sum(disk_usage(os.path.join(directory, shard['filename'])) for shard in json.load(f)['shards'])
+    return total
+
+
+def shard_index_filename(outfile: Union[str, os.PathLike]) -> str:
+    """Name of the JSON index written next to a set of shards, e.g. movie.mp4 -> movie.mp4.shards.json"""
+    return str(outfile) + '.shards.json'
+
+
+def shard_filename(filename: Union[str, os.PathLike], shard: int) -> str:
+    """movie.mp4 -> movie_00003.mp4"""
+    base, ext = os.path.splitext(str(filename))
+    return '{}_{:05d}{}'.format(base, shard, ext)
+
+
+class ShardedWriter:
+    """Splits one logical video into files of at most shard_frames frames each, plus a JSON index.
+
+    movie.mp4 is written as movie_00000.mp4, movie_00001.mp4, ... and movie.mp4.shards.json. Every shard is its own
+    file, so each one starts on a keyframe and can be uploaded, read or validated independently. The index maps global
+    frame numbers to (shard, local frame); see readers.ShardedReader to read the shards back as one video.
+    """
+
+    def __init__(self, filename: Union[str, os.PathLike], movie_format: str, shard_frames: int, **kwargs):
+        if shard_frames < 1:
+            raise ValueError('shard_frames must be positive, not {}'.format(shard_frames))
+        self.filename = str(filename)
+        self.movie_format = movie_format
+        self.shard_frames = int(shard_frames)
+        self.kwargs = kwargs
+        self.index_file = shard_index_filename(self.filename)
+
+        self.shards = []
+        self.writer = None
+        self.nframes = 0
+        self.has_stopped = False
+
+    def shard_filename(self, shard: int) -> str:
+        return shard_filename(self.filename, shard)
+
+    def start_shard(self):
+        if self.writer is not None:
+            self.writer.close()
+        filename = self.shard_filename(len(self.shards))
+        self.writer = make_writer(filename, self.movie_format, **self.kwargs)
+        # vidio can change the filename, e.g. removing the extension for image folders
+        filename = getattr(self.writer, 'filename', filename)
+        self.shards.append({'filename': os.path.basename(filename), 'start': self.nframes, 'nframes': 0})
+
+    def write(self, frame: np.ndarray):
+        if self.writer is None or self.shards[-1]['nframes'] == self.shard_frames:
+            self.start_shard()
+        self.writer.write(frame)
+        self.shards[-1]['nframes'] += 1
+        self.nframes += 1
+
+    def write_index(self):
+        index = {'movie_format': self.movie_format,
+                 'fps': self.kwargs.get('fps'),
+                 'shard_frames': self.shard_frames,
+                 'nframes': self.nframes,
+                 'shards': self.shards}
+        with open(self.index_file, 'w') as f:
+            json.dump(index, f, indent=2)
+
+    def close(self):
+        if self.has_stopped:
+            return
+        self.has_stopped = True
+        if self.writer is not None:
+            self.writer.close()
+        self.write_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class TeeWriter:
+    """Writes the same frames to several VideoWriters, each in its own thread.
+
+    With shard_frames, each output is a ShardedWriter instead of a single file. Formats that only support 8 bits get
+    non-uint8 frames converted in their own thread, using bit_depth (see bitdepth.convert_dtype).
+
+    Each writer has a bounded queue, so a slow writer can fall at most buffer_size frames behind before write()
+    blocks. Frames are copied once on write and shared between all writer threads, so callers may reuse their frame
+    buffer immediately. Errors raised in a writer thread are re-raised in the caller on the next write or on close.
+
+    Example:
+        with TeeWriter(['movie.mp4', 'movie.h5'], ['ffmpeg', 'hdf5'], fps=30) as writer:
+            for frame in frames:
+                writer.write(frame)
+    """
+
+    def __init__(self, filenames: Sequence[Union[str, os.PathLike]], movie_formats: Sequence[str],
+                 buffer_size: int = 64, shard_frames: int = None, bit_depth: int = None, **kwargs):
+        assert len(filenames) == len(movie_formats)
+        self.filenames = [str(i) for i in filenames]
+        self.movie_formats = list(movie_formats)
+        self.writers = []
+        self.queues = []
+        self.threads = []
+        self.errors = []
+        self.bit_depth = bit_depth
+        self.has_stopped = False
+        for filename, movie_format in zip(self.filenames, self.movie_formats):
+            if shard_frames is None:
+                writer = make_writer(filename, movie_format, asynchronous=False, **kwargs)
+            else:
+                writer = ShardedWriter(filename, movie_format, shard_frames, asynchronous=False, **kwargs)
+            queue = Queue(maxsize=buffer_size)
+            thread = Thread(target=self.save_worker, args=(writer, queue, movie_format not in native_formats))
+            thread.daemon = True
+            thread.start()
+            self.writers.append(writer)
+            self.queues.append(queue)
+            self.threads.append(thread)
+
+    def save_worker(self, writer, queue: Queue, eight_bit: bool = False):
+        """Worker that drains one queue into one writer. Keeps draining after an error so write() can't deadlock"""
+        failed = False
+        # the writers are synchronous, so one conversion buffer per thread can be reused for every frame
+        out = None
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if failed:
+                continue
+            try:
+                if eight_bit and item.dtype != np.uint8:
+                    if out is None or out.shape != item.shape:
+                        out = np.empty(item.shape, dtype=np.uint8)
+                    item = convert_dtype(item, np.uint8, out=out, bit_depth=self.bit_depth)
+                writer.write(item)
+            except BaseException as e:
+                self.errors.append(e)
+                failed = True
+        try:
+            writer.close()
+        except BaseException as e:
+            if not failed:
+                self.errors.append(e)
+
+    @property
+    def output_files(self) -> list:
+        """Files actually written, one per format. Writers may change extensions; sharded outputs give their index"""
+        return [getattr(writer, 'index_file', None) or writer.filename for writer in self.writers]
+
+    def check_errors(self):
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def write(self, frame: np.ndarray):
+        self.check_errors()
+        frame = np.array(frame, copy=True)
+        for queue in self.queues:
+            queue.put(frame)
+
+    def close(self):
+        if self.has_stopped:
+            return
+        self.has_stopped = True
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.check_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except BaseException:
+            pass